@@ -0,0 +1,208 @@
+#!/usr/bin/env python3.8
+# -*- coding: utf-8 -*-
+
+
+"""Benchmarks for the dbase module.
+
+These benchmarks write to a throwaway 'benchmark' database. Run the following from the /utility_scripts_package
+directory against a local mongod (or set MONGO_BENCH_URI):
+
+(or just python for windows)
+python3 -m benchmarks.bench_dbase
+
+Supply --mongomock to use mongomock instead of a server when only relative numbers matter. Use --suite to run only
+some of the benchmarks, e.g. --suite insert upsert, and --help for the sizes that can be changed.
+
+Each case runs in a fresh child process so the reported peak RSS (resident memory) belongs to that case alone.
+
+Suites:
+
+    insert
+        - insert_into_mongo throughput across batch sizes, document sizes and worker counts.
+
+    upsert
+        - upsert_into_mongo and bulk_upsert_into_mongo (plain and diff) throughput across existing collection sizes,
+          with and without an index on the unique_id field.
+
+    dataframe
+        - pd.DataFrame(list(collection.find())) compared with mongo_to_dataframe.
+"""
+
+
+import argparse
+import multiprocessing
+import os
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+from bson import Decimal128
+
+from utility_scripts import dbase
+
+try:
+    import resource
+except ImportError:
+    # peak RSS is not reported on windows
+    resource = None
+
+
+# approximate padding for the document sizes
+DOC_SIZES = {'small': 0, 'large': 2000}
+
+
+def get_collection(mongomock=False):
+    """Return an empty benchmark collection."""
+    if mongomock:
+        import mongomock as mm
+        client = mm.MongoClient()
+    else:
+        client = dbase.get_mongo_client(os.getenv('MONGO_BENCH_URI', 'mongodb://localhost:27017'), shared=False)
+    col = client['benchmark']['benchmark']
+    col.drop()
+    return col
+
+
+def make_documents(n, start=0, doc_size='small', base=datetime(2021, 1, 1)):
+    """Yield n documents with a mix of string, numeric, decimal and date fields, keyed by a unique 'key' field."""
+    padding = 'x' * DOC_SIZES[doc_size]
+    for i in range(start, start + n):
+        doc = {'key': i, 'name': f'name{i}', 'group': f'group{i % 50}', 'value': i, 'ratio': i / 7,
+               'amount': Decimal128(f'{i}.25'), 'created': base + timedelta(seconds=i)}
+        if padding:
+            doc['padding'] = padding
+        yield doc
+
+
+def peak_rss_mb():
+    """Return the peak resident memory of this process in MB, or None if it can't be measured."""
+    if resource is None:
+        return None
+    # ru_maxrss is in KB on linux and bytes on macos
+    scale = 2 ** 20 if os.uname().sysname == 'Darwin' else 2 ** 10
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+# benchmark cases: each sets up its collection, then returns (documents processed, seconds) for the timed part only
+def case_insert(col, docs, batch_size, doc_size, workers):
+    records = make_documents(docs, doc_size=doc_size)
+    start = time.perf_counter()
+    dbase.insert_into_mongo(records, col, batch_size=batch_size, workers=workers)
+    return docs, time.perf_counter() - start
+
+
+def case_upsert(col, docs, existing, method, indexed, doc_size):
+    dbase.insert_into_mongo(make_documents(existing, doc_size=doc_size), col, batch_size=10000)
+    if indexed:
+        col.create_index([('key', 1)])
+    index = 'create' if indexed else 'ignore'
+
+    # half of the records replace existing documents (when there are any), the rest are new
+    records = make_documents(docs, start=max(0, existing - docs // 2), doc_size=doc_size)
+    start = time.perf_counter()
+    if method == 'upsert_into_mongo':
+        dbase.upsert_into_mongo(list(records), 'key', col, index=index)
+    elif method == 'bulk_upsert_into_mongo':
+        dbase.bulk_upsert_into_mongo(records, 'key', col, index=index)
+    else:
+        dbase.bulk_upsert_into_mongo(records, 'key', col, index=index, diff=True)
+    return docs, time.perf_counter() - start
+
+
+def case_dataframe(col, docs, method, doc_size):
+    dbase.insert_into_mongo(make_documents(docs, doc_size=doc_size), col, batch_size=10000)
+    start = time.perf_counter()
+    if method == 'pd.DataFrame(list(find()))':
+        df = pd.DataFrame(list(col.find()))
+    else:
+        df = dbase.mongo_to_dataframe(col)
+    return len(df), time.perf_counter() - start
+
+
+def run_case(fxn, mongomock, kwargs):
+    """Run one benchmark case (in a child process) and return (documents, seconds, peak RSS MB)."""
+    col = get_collection(mongomock)
+    try:
+        docs, seconds = fxn(col, **kwargs)
+    finally:
+        col.drop()
+    return docs, seconds, peak_rss_mb()
+
+
+def build_cases(args):
+    """Return a list of (suite, description, case function, keyword arguments) for the selected suites."""
+    cases = []
+
+    if 'insert' in args.suite:
+        for doc_size in args.doc_sizes:
+            for batch_size in args.batch_sizes:
+                for workers in args.workers:
+                    cases.append(('insert', f'batch_size={batch_size} doc_size={doc_size} workers={workers}',
+                                  case_insert, {'docs': args.docs, 'batch_size': batch_size, 'doc_size': doc_size,
+                                                'workers': workers}))
+
+    if 'upsert' in args.suite:
+        methods = ['bulk_upsert_into_mongo', 'bulk_upsert_into_mongo(diff)']
+        if not args.skip_legacy:
+            methods.insert(0, 'upsert_into_mongo')
+        for existing in args.collection_sizes:
+            for indexed in (True, False):
+                for method in methods:
+                    cases.append(('upsert', f'{method} existing={existing} indexed={indexed}', case_upsert,
+                                  {'docs': args.docs, 'existing': existing, 'method': method, 'indexed': indexed,
+                                   'doc_size': 'small'}))
+
+    if 'dataframe' in args.suite:
+        for doc_size in args.doc_sizes:
+            for method in ('pd.DataFrame(list(find()))', 'mongo_to_dataframe'):
+                cases.append(('dataframe', f'{method} doc_size={doc_size}', case_dataframe,
+                              {'docs': args.docs, 'method': method, 'doc_size': doc_size}))
+
+    return cases
+
+
+def report(results):
+    """Print a table of results grouped by suite."""
+    suite = None
+    for name, description, docs, seconds, rss in results:
+        if name != suite:
+            suite = name
+            print(f'\n{suite}')
+            print(f'{"case":<70}{"docs":>10}{"seconds":>10}{"docs/sec":>12}{"peak MB":>10}')
+        rss = f'{rss:>10.1f}' if rss is not None else f'{"n/a":>10}'
+        rate = docs / seconds if seconds else float('inf')
+        print(f'{description:<70}{docs:>10}{seconds:>10.2f}{rate:>12.0f}{rss}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the dbase Mongo helpers.')
+    parser.add_argument('--suite', nargs='+', default=['insert', 'upsert', 'dataframe'],
+                        choices=['insert', 'upsert', 'dataframe'], help='the benchmarks to run')
+    parser.add_argument('--docs', type=int, default=20000, help='number of documents inserted/upserted/read per case')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='insert batch sizes')
+    parser.add_argument('--doc-sizes', nargs='+', default=['small', 'large'], choices=list(DOC_SIZES),
+                        help='document sizes')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4], help='insert worker thread counts')
+    parser.add_argument('--collection-sizes', type=int, nargs='+', default=[0, 100000],
+                        help='number of documents already in the collection before upserting')
+    parser.add_argument('--skip-legacy', action='store_true',
+                        help='skip upsert_into_mongo, which is very slow on large unindexed collections')
+    parser.add_argument('--mongomock', action='store_true', help='use mongomock instead of a mongod server')
+    args = parser.parse_args()
+
+    # a fresh process per case keeps the peak RSS of each case separate
+    context = multiprocessing.get_context('fork' if hasattr(os, 'fork') else 'spawn')
+
+    results = []
+    for suite, description, fxn, kwargs in build_cases(args):
+        with context.Pool(1) as pool:
+            docs, seconds, rss = pool.apply(run_case, (fxn, args.mongomock, kwargs))
+        results.append((suite, description, docs, seconds, rss))
+        print(f'{suite}: {description}: {docs / seconds if seconds else 0:.0f} docs/sec', flush=True)
+
+    report(results)
+
+
+if __name__ == '__main__':
+    main()
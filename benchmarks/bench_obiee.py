@@ -0,0 +1,131 @@
+#!/usr/bin/env python3.8
+# -*- coding: utf-8 -*-
+
+
+"""Benchmarks for converting OBIEE (JDBC) results into dataframes.
+
+No OBIEE server is needed: the rows are synthetic, in the form jaydebeapi returns them (dates and timestamps as
+strings, decimals as python floats/ints, a description with jaydebeapi type codes). Run the following from the
+/utility_scripts_package directory:
+
+(or just python for windows)
+python3 -m benchmarks.bench_obiee
+
+Each case runs in a fresh child process so the reported peak RSS (resident memory) belongs to that case alone. The
+frame MB column counts the strings of object columns, which the frame shares with the fetched rows, so compare peak
+RSS for memory.
+
+Methods:
+
+    pd.DataFrame(rows)
+        - what submit_query did before, leaving dates, decimals and strings as object columns
+
+    pd.DataFrame(rows) + convert
+        - the same, then converting each column to the dtypes jdbc_rows_to_dataframe chooses
+
+    jdbc_rows_to_dataframe
+        - the columnar, type-aware conversion submit_query uses now
+"""
+
+
+import argparse
+import multiprocessing
+import os
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from benchmarks.bench_dbase import peak_rss_mb
+from utility_scripts import dbase
+
+jdbc = dbase.jaydebeapi
+
+# the repeating column types of the synthetic results: (name, type code, scale)
+COLUMN_TYPES = [
+    ('day', jdbc.DATE, 0),
+    ('updated', jdbc.DATETIME, 6),
+    ('count', jdbc.NUMBER, 0),
+    ('amount', jdbc.DECIMAL, 2),
+    ('ratio', jdbc.FLOAT, 0),
+    ('region', jdbc.STRING, 0),
+    ('description', jdbc.STRING, 0),
+]
+
+
+def make_results(rows, columns, base=datetime(2021, 1, 1)):
+    """Return (rows, description) for a synthetic result of rows x columns, about 10% of the values null."""
+    types = [COLUMN_TYPES[i % len(COLUMN_TYPES)] for i in range(columns)]
+    description = [(f'{name}{i}', type_code, 20, 20, 20, scale, 1) for i, (name, type_code, scale) in enumerate(types)]
+
+    def value(name, i):
+        if i % 10 == 9:
+            return None
+        if name == 'day':
+            return str((base + timedelta(days=i % 1000)).date())
+        if name == 'updated':
+            return str(base + timedelta(seconds=i, microseconds=i % 3 * 250000))
+        if name == 'count':
+            return i
+        if name == 'amount':
+            return i + 0.25
+        if name == 'ratio':
+            return i / 7
+        if name == 'region':
+            return f'region{i % 20}'
+        return f'description {i}'
+
+    data = [tuple(value(name, i + j) for j, (name, type_code, scale) in enumerate(types)) for i in range(rows)]
+    return data, description
+
+
+def convert_after(df, description):
+    """Convert a pd.DataFrame(rows) result to the dtypes jdbc_rows_to_dataframe would choose."""
+    for name, type_code, *rest in description:
+        if type_code is jdbc.DATE or type_code is jdbc.DATETIME:
+            df[name] = pd.to_datetime(df[name], format='ISO8601')
+        elif type_code is jdbc.NUMBER:
+            df[name] = df[name].astype('Int64')
+        elif type_code is jdbc.DECIMAL or type_code is jdbc.FLOAT:
+            df[name] = df[name].astype('float64')
+        elif type_code is jdbc.STRING:
+            df[name] = df[name].astype(object)
+    return df
+
+
+def run_case(method, rows, columns):
+    """Run one benchmark case (in a child process) and return (rows, seconds, frame MB, peak RSS MB)."""
+    data, description = make_results(rows, columns)
+    start = time.perf_counter()
+    if method == 'jdbc_rows_to_dataframe':
+        df = dbase.jdbc_rows_to_dataframe(data, description)
+    else:
+        df = pd.DataFrame(data, columns=[i[0] for i in description])
+        if method == 'pd.DataFrame(rows) + convert':
+            df = convert_after(df, description)
+    seconds = time.perf_counter() - start
+    return len(df), seconds, df.memory_usage(deep=True).sum() / 2 ** 20, peak_rss_mb()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark converting OBIEE results into dataframes.')
+    parser.add_argument('--rows', type=int, default=100000, help='number of rows per result')
+    parser.add_argument('--columns', type=int, nargs='+', default=[7, 70], help='numbers of columns per result')
+    args = parser.parse_args()
+
+    # a fresh process per case keeps the peak RSS of each case separate
+    context = multiprocessing.get_context('fork' if hasattr(os, 'fork') else 'spawn')
+
+    print(f'{"case":<50}{"rows":>10}{"seconds":>10}{"rows/sec":>12}{"frame MB":>10}{"peak MB":>10}')
+    for columns in args.columns:
+        for method in ('pd.DataFrame(rows)', 'pd.DataFrame(rows) + convert', 'jdbc_rows_to_dataframe'):
+            with context.Pool(1) as pool:
+                rows, seconds, frame_mb, rss = pool.apply(run_case, (method, args.rows, columns))
+            rss = f'{rss:>10.1f}' if rss is not None else f'{"n/a":>10}'
+            rate = rows / seconds if seconds else float('inf')
+            print(f'{f"{method} columns={columns}":<50}{rows:>10}{seconds:>10.2f}{rate:>12.0f}{frame_mb:>10.1f}{rss}',
+                  flush=True)
+
+
+if __name__ == '__main__':
+    main()
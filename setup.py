@@ -41,7 +41,7 @@ setuptools.setup(
         'dash-bootstrap-components',
         'python-dotenv',
         'jaydebeapi',
-        'pandas',
+        'pandas>=2',
         'paramiko',
         'pymongo',
         'pytest'
@@ -125,5 +125,18 @@ class TestDashFigure(unittest.TestCase):
         self.assertIsInstance(self.figure.children, dbc.Tabs)
 
 
+class TestServerSideDashTable(unittest.TestCase):
+    def setUp(self):
+        self.table = dash_tools.get_server_side_dash_table('table-id', ['strings', 'integers'], page_size=25,
+                                                           sort_action='custom')
+
+    def test_get_server_side_dash_table(self):
+        self.assertIsInstance(self.table, dash_table.DataTable)
+        self.assertEqual(self.table.page_action, 'custom')
+        self.assertEqual(self.table.sort_action, 'custom')
+        self.assertEqual(self.table.page_size, 25)
+        self.assertListEqual(self.table.data, [])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -4,8 +4,16 @@
 
 from utility_scripts import email
 
+import email as stdlib_email
+
 import os
+import queue
+import smtplib
+import sqlite3
+import tempfile
+import threading
 import unittest
+from unittest import mock
 
 
 class TestEmailValidationFxn(unittest.TestCase):
@@ -374,5 +382,327 @@ class TestSendEmailTLSWithoutPassword(unittest.TestCase):
         self.mail = None
 
 
+class TestMailSession(unittest.TestCase):
+    def setUp(self):
+        self.mail = email.Mail()
+        self.mail.sender = 'mail@mail.com'
+        self.mail.recipient = 'mail@mail.com'
+        self.mail.subject = 'subject'
+        self.mail.body = 'body'
+        self.mail.host = 'host.host.host'
+        self.mail.port = 25
+        patcher = mock.patch.object(email.smtplib, 'SMTP')
+        self.smtp_class = patcher.start()
+        self.smtp = self.smtp_class.return_value
+        self.smtp.sendmail.return_value = {}
+        self.addCleanup(patcher.stop)
+
+    def test_send_mail(self):
+        self.mail.tls = True
+        self.mail.username = 'username'
+        self.mail.password = 'supersecret'
+        self.mail.send_mail()
+        self.smtp_class.assert_called_once_with('host.host.host', 25)
+        self.smtp.starttls.assert_called_once()
+        self.smtp.login.assert_called_once_with('username', 'supersecret')
+        self.assertEqual(self.smtp.sendmail.call_args[0][:2], ('mail@mail.com', ['mail@mail.com']))
+        self.smtp.quit.assert_called_once()
+        self.smtp.close.assert_not_called()
+
+    def test_session_reuses_the_connection(self):
+        with self.mail.session() as session:
+            for addr in ['aa@test.com', 'bb@test.com', 'cc@test.com']:
+                session.send(recipient=addr)
+        self.assertEqual(self.smtp_class.call_count, 1)
+        self.assertEqual(session.sent, 3)
+        self.assertEqual(self.smtp.sendmail.call_args[0][1], ['cc@test.com'])
+        # the Mail object itself is unchanged
+        self.assertEqual(self.mail.recipient, 'mail@mail.com')
+
+    def test_session_reconnects(self):
+        self.smtp.sendmail.side_effect = [{}, smtplib.SMTPServerDisconnected('timed out'), {},
+                                          smtplib.SMTPSenderRefused(421, b'closing', 'mail@mail.com'), {}]
+        with self.mail.session() as session:
+            for _ in range(3):
+                session.send()
+        self.assertEqual(self.smtp_class.call_count, 3)
+        self.assertEqual(session.sent, 3)
+
+    def test_max_messages(self):
+        with self.mail.session(max_messages=2) as session:
+            for _ in range(5):
+                session.send()
+        self.assertEqual(self.smtp_class.call_count, 3)
+
+    def test_send_batch_outcomes(self):
+        self.smtp.sendmail.side_effect = [{}, smtplib.SMTPRecipientsRefused({'bb@test.com': (550, b'no such user')})]
+        outcomes = self.mail.send_batch([{'recipient': 'aa@test.com'}, {'recipient': 'bb@test.com'},
+                                         {'recipient': 'not an email'}, {'colour': 'blue'}])
+        self.assertListEqual([i['sent'] for i in outcomes], [True, False, False, False])
+        self.assertDictEqual(outcomes[1]['refused'], {'bb@test.com': (550, b'no such user')})
+        self.assertIsInstance(outcomes[2]['error'], email.InvalidEmailFormatError)
+        self.assertIsInstance(outcomes[3]['error'], AttributeError)
+        self.assertEqual(self.smtp_class.call_count, 1)
+
+    def tearDown(self):
+        self.mail = None
+
+
+class TestMailRecipients(unittest.TestCase):
+    def setUp(self):
+        self.mail = email.Mail()
+        self.mail.sender = 'mail@mail.com'
+        self.mail.recipient = ['to1@test.com', 'to2@test.com']
+        self.mail.cc = 'cc@test.com'
+        self.mail.bcc = ['bcc' + str(i) + '@test.com' for i in range(5)] + ['to1@test.com']
+        self.mail.subject = 'subject'
+        self.mail.body = 'body'
+        self.mail.host = 'host.host.host'
+        patcher = mock.patch.object(email.smtplib, 'SMTP')
+        self.smtp_class = patcher.start()
+        self.smtp = self.smtp_class.return_value
+        self.addCleanup(patcher.stop)
+
+    def test_validation(self):
+        self.assertListEqual(self.mail.cc, ['cc@test.com'])
+        for attr in ['recipient', 'cc', 'bcc']:
+            self.assertRaises(email.InvalidEmailFormatError, setattr, self.mail, attr, ['ok@test.com', 'nope.com'])
+            self.assertRaises(TypeError, setattr, self.mail, attr, [4])
+        self.assertRaises(TypeError, setattr, self.mail, 'max_recipients', 0)
+
+    def test_headers(self):
+        message = self.mail._build_message()
+        self.assertEqual(message['To'], 'to1@test.com, to2@test.com')
+        self.assertEqual(message['Cc'], 'cc@test.com')
+        self.assertIsNone(message['Bcc'])
+        self.assertEqual(len(self.mail.envelope_recipients()), 8)
+
+    def test_chunks_and_refusals(self):
+        self.mail.max_recipients = 3
+        self.smtp.sendmail.side_effect = [
+            {'to2@test.com': (550, b'no such user')},
+            smtplib.SMTPRecipientsRefused({'bcc1@test.com': (550, b'no'), 'bcc2@test.com': (550, b'no'),
+                                           'bcc3@test.com': (550, b'no')}),
+            {},
+        ]
+        refused = self.mail.send_mail()
+        self.assertEqual(self.smtp_class.call_count, 1)
+        self.assertListEqual([len(i[0][1]) for i in self.smtp.sendmail.call_args_list], [3, 3, 2])
+        self.assertListEqual(sorted(refused), ['bcc1@test.com', 'bcc2@test.com', 'bcc3@test.com', 'to2@test.com'])
+        # the message is built once and sent to every chunk
+        self.assertEqual(len({i[0][2] for i in self.smtp.sendmail.call_args_list}), 1)
+
+    def test_every_recipient_refused(self):
+        self.mail.max_recipients = 4
+
+        def refuse(sender, recipients, message):
+            raise smtplib.SMTPRecipientsRefused({i: (550, b'no') for i in recipients})
+
+        self.smtp.sendmail.side_effect = refuse
+        with self.assertRaises(smtplib.SMTPRecipientsRefused) as cm:
+            self.mail.send_mail()
+        self.assertEqual(len(cm.exception.recipients), 8)
+
+    def test_closing_during_rcpt(self):
+        self.mail.max_recipients = 4
+        closing = (421, b'closing')
+        self.smtp.sendmail.side_effect = [
+            smtplib.SMTPRecipientsRefused({'to1@test.com': closing}), {},
+            smtplib.SMTPRecipientsRefused({'bcc2@test.com': closing}),
+            smtplib.SMTPRecipientsRefused({'bcc3@test.com': closing}),
+        ]
+        refused = self.mail.send_mail()
+        # the first chunk is retried on a new connection, the second fails twice and every address in it is refused
+        self.assertEqual(self.smtp_class.call_count, 3)
+        self.assertListEqual(sorted(refused), ['bcc1@test.com', 'bcc2@test.com', 'bcc3@test.com', 'bcc4@test.com'])
+        self.assertTrue(all(i == closing for i in refused.values()))
+
+    def tearDown(self):
+        self.mail = None
+
+
+class TestStreamingAttachments(unittest.TestCase):
+    def setUp(self):
+        self.mail = email.Mail()
+        self.mail.sender = 'mail@mail.com'
+        self.mail.recipient = 'mail@mail.com'
+        self.mail.subject = 'subject'
+        self.mail.body = 'body\n.starts with a dot'
+        self.mail.host = 'host.host.host'
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.data = os.urandom(email.StreamingMessage.CHUNK_SIZE * 3 + 100)
+        self.files = [os.path.join(tmp.name, 'data.bin'), os.path.join(tmp.name, 'report.csv')]
+        with open(self.files[0], 'wb') as file:
+            file.write(self.data)
+        with open(self.files[1], 'w') as file:
+            file.write('a,b\n1,2\n')
+        self.mail.attachment = self.files
+
+        patcher = mock.patch.object(email.smtplib, 'SMTP')
+        self.smtp = patcher.start().return_value
+        self.smtp.mail.return_value = (250, b'ok')
+        self.smtp.rcpt.return_value = (250, b'ok')
+        self.smtp.getreply.side_effect = [(354, b'go ahead'), (250, b'ok')]
+        self.addCleanup(patcher.stop)
+
+    def test_attachment_validation(self):
+        self.assertListEqual(self.mail.attachment, self.files)
+        self.assertRaises(FileNotFoundError, setattr, self.mail, 'attachment', [self.files[0], 'not/a/file.txt'])
+        self.assertRaises(TypeError, setattr, self.mail, 'attachment', [self.files[0], 4])
+
+    def test_attachments_are_streamed(self):
+        self.assertDictEqual(self.mail.send_mail(), {})
+        self.smtp.sendmail.assert_not_called()
+        chunks = [i[0][0] for i in self.smtp.send.call_args_list]
+        self.assertLess(max(len(i) for i in chunks), email.StreamingMessage.CHUNK_SIZE * 2)
+        self.assertEqual(chunks[-1], b'.\r\n')
+
+        # undo the SMTP line endings and dot escaping to read the message back
+        data = b''.join(chunks[:-1]).replace(b'\r\n', b'\n').replace(b'\n..', b'\n.')
+        message = stdlib_email.message_from_bytes(data)
+        parts = message.get_payload()
+        self.assertEqual(parts[0].get_payload(), 'body\n.starts with a dot')
+        self.assertEqual(parts[1].get_content_type(), 'application/octet-stream')
+        self.assertEqual(parts[1].get_payload(decode=True), self.data)
+        self.assertEqual(parts[2].get_content_type(), 'text/csv')
+        self.assertEqual(parts[2].get_filename(), 'report.csv')
+        self.assertEqual(parts[2].get_payload(decode=True), b'a,b\n1,2\n')
+
+    def test_as_string(self):
+        message = stdlib_email.message_from_string(self.mail._build_message().as_string())
+        self.assertEqual(message.get_payload()[1].get_payload(decode=True), self.data)
+
+
+class TestMailQueue(unittest.TestCase):
+    def setUp(self):
+        self.mail = email.Mail()
+        self.mail.sender = 'mail@mail.com'
+        self.mail.recipient = 'mail@mail.com'
+        self.mail.subject = 'subject'
+        self.mail.body = 'body'
+        self.mail.host = 'host.host.host'
+        patcher = mock.patch.object(email.smtplib, 'SMTP')
+        self.smtp = patcher.start().return_value
+        self.smtp.sendmail.return_value = {}
+        self.addCleanup(patcher.stop)
+
+    def test_send_mail_returns_a_future(self):
+        self.mail.start_queue(workers=2)
+        futures = [self.mail.send_mail() for _ in range(5)]
+        self.assertTrue(self.mail.stop_queue(timeout=5))
+        self.assertListEqual([i.result() for i in futures], [{}] * 5)
+        self.assertEqual(self.smtp.sendmail.call_count, 5)
+        # sends directly once the queue is stopped
+        self.assertDictEqual(self.mail.send_mail(), {})
+
+    def test_transient_failures_are_retried(self):
+        self.smtp.sendmail.side_effect = [smtplib.SMTPDataError(451, b'try again later'), {},
+                                          smtplib.SMTPDataError(550, b'rejected')]
+        self.mail.start_queue(workers=1, backoff=0.01)
+        retried = self.mail.send_mail()
+        self.assertEqual(retried.result(timeout=5), {})
+        failed = self.mail.send_mail()
+        self.assertIsInstance(failed.exception(timeout=5), smtplib.SMTPDataError)
+        self.mail.stop_queue()
+        self.assertEqual(self.smtp.sendmail.call_count, 3)
+
+    def test_bounded_queue(self):
+        release = threading.Event()
+        self.smtp.sendmail.side_effect = lambda *args: release.wait(5) and {}
+        mail_queue = self.mail.start_queue(workers=1, max_size=2)
+        self.mail.send_mail()
+        self.mail.send_mail()
+        self.assertRaises(queue.Full, mail_queue.put, 'message', 'mail@mail.com', 'mail@mail.com', block=False)
+        self.assertRaises(queue.Full, mail_queue.put, 'message', 'mail@mail.com', 'mail@mail.com', timeout=0.05)
+        release.set()
+        self.assertTrue(mail_queue.drain(timeout=5))
+        self.mail.stop_queue()
+
+    def test_cancelled_messages_are_skipped(self):
+        release = threading.Event()
+        self.smtp.sendmail.side_effect = lambda *args: release.wait(5) and {}
+        mail_queue = self.mail.start_queue(workers=1)
+        sending = self.mail.send_mail()
+        cancelled = self.mail.send_mail()
+        self.assertTrue(cancelled.cancel())
+        release.set()
+        self.assertTrue(mail_queue.drain(timeout=5))
+        self.assertEqual(sending.result(), {})
+        self.assertEqual(self.smtp.sendmail.call_count, 1)
+        # the worker is still delivering
+        self.assertEqual(self.mail.send_mail().result(timeout=5), {})
+        self.mail.stop_queue()
+
+
+class TestMailSpool(unittest.TestCase):
+    def setUp(self):
+        self.mail = email.Mail()
+        self.mail.sender = 'mail@mail.com'
+        self.mail.recipient = 'mail@mail.com'
+        self.mail.subject = 'subject'
+        self.mail.body = 'body'
+        self.mail.host = 'host.host.host'
+        patcher = mock.patch.object(email.smtplib, 'SMTP')
+        self.smtp = patcher.start().return_value
+        self.smtp.sendmail.return_value = {}
+        self.addCleanup(patcher.stop)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'spool.db')
+
+    def test_send_mail_returns_spool_id(self):
+        spool = self.mail.start_spool(self.path)
+        ids = [self.mail.send_mail() for _ in range(3)]
+        self.assertTrue(spool.drain(timeout=5))
+        self.assertListEqual([spool.status(i)['status'] for i in ids], ['sent'] * 3)
+        self.assertEqual(spool.pending(), 0)
+        self.assertTrue(self.mail.stop_queue())
+        self.assertEqual(self.smtp.sendmail.call_count, 3)
+
+    def test_retries_and_failures_are_recorded(self):
+        self.smtp.sendmail.side_effect = [smtplib.SMTPDataError(451, b'try again later'),
+                                          smtplib.SMTPDataError(550, b'rejected')]
+        spool = self.mail.start_spool(self.path, backoff=0.01)
+        message_id = self.mail.send_mail()
+        self.assertTrue(spool.drain(timeout=5))
+        status = spool.status(message_id)
+        self.assertEqual(status['status'], 'failed')
+        self.assertEqual(status['attempts'], 2)
+        self.assertIn('rejected', status['error'])
+        self.mail.stop_queue()
+
+    def test_message_put_after_an_empty_claim_is_sent(self):
+        spool = self.mail.start_spool(self.path)
+        claim = spool._MailSpool__claim
+        late = []
+
+        def claim_then_put():
+            rows, next_due = claim()
+            if not rows and not late:
+                # a message arriving between the empty claim and the wait for new messages
+                late.append(spool.put('message', 'mail@mail.com', 'mail@mail.com'))
+            return rows, next_due
+
+        spool._MailSpool__claim = claim_then_put
+        self.mail.send_mail()
+        self.assertTrue(spool.drain(timeout=5))
+        self.assertEqual(spool.status(late[0])['status'], 'sent')
+        self.mail.stop_queue()
+
+    def test_unfinished_messages_are_recovered(self):
+        self.mail.start_spool(self.path)
+        self.mail.stop_queue()
+        # a message claimed by a worker when the process died
+        with sqlite3.connect(self.path) as db:
+            db.execute("INSERT INTO spool (sender, recipients, message, status, next_attempt) "
+                       "VALUES ('mail@mail.com', '\"mail@mail.com\"', 'message', 'sending', 0)")
+        spool = self.mail.start_spool(self.path)
+        self.assertTrue(spool.drain(timeout=5))
+        self.assertEqual(spool.status(1)['status'], 'sent')
+        self.smtp.sendmail.assert_called_once_with('mail@mail.com', ['mail@mail.com'], 'message')
+        self.mail.stop_queue()
+
+
 if __name__ == '__main__':
     unittest.main()
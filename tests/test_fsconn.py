@@ -5,9 +5,14 @@
 """Unit tests for the fsconn module."""
 
 import os
+import tempfile
+import threading
 import unittest
+from unittest import mock
 from utility_scripts import fsconn
 
+import paramiko
+
 
 class TestInitFSConn(unittest.TestCase):
     def setUp(self):
@@ -109,6 +114,75 @@ class InvalidDataTypes(unittest.TestCase):
             except Exception as e:
                 self.assertIsInstance(e, TypeError)
 
+    def test_use_agent(self):
+        for item in ['nope', 4, []]:
+            try:
+                self.conn.use_agent = item
+                raise Exception
+            except Exception as e:
+                self.assertIsInstance(e, TypeError)
+
+
+class TestKeyCache(unittest.TestCase):
+    def setUp(self):
+        fsconn.clear_key_cache()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.rsa_path = os.path.join(self.tmpdir.name, 'id_rsa')
+        self.ecdsa_path = os.path.join(self.tmpdir.name, 'id_ecdsa')
+        paramiko.RSAKey.generate(2048).write_private_key_file(self.rsa_path, password='secret')
+        paramiko.ECDSAKey.generate().write_private_key_file(self.ecdsa_path)
+
+    def test_key_is_cached(self):
+        key = fsconn.load_private_key(self.rsa_path, passphrase='secret')
+        self.assertIsInstance(key, paramiko.RSAKey)
+        self.assertIs(key, fsconn.load_private_key(self.rsa_path, passphrase='secret'))
+
+    def test_modified_key_is_reloaded(self):
+        key = fsconn.load_private_key(self.ecdsa_path)
+        self.assertIsInstance(key, paramiko.ECDSAKey)
+        stat = os.stat(self.ecdsa_path)
+        os.utime(self.ecdsa_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertIsNot(key, fsconn.load_private_key(self.ecdsa_path))
+
+    def test_missing_passphrase(self):
+        self.assertRaises(paramiko.PasswordRequiredException, fsconn.load_private_key, self.rsa_path)
+
+    def test_wrong_passphrase_is_not_served_from_cache(self):
+        fsconn.load_private_key(self.rsa_path, passphrase='secret')
+        self.assertRaises(paramiko.SSHException, fsconn.load_private_key, self.rsa_path, passphrase='wrong')
+        self.assertRaises(paramiko.PasswordRequiredException, fsconn.load_private_key, self.rsa_path)
+
+    def test_parsing_one_key_does_not_block_others(self):
+        parsing = threading.Event()
+        release = threading.Event()
+        parse = paramiko.RSAKey.from_private_key_file
+
+        def slow_parse(filename, **kwargs):
+            if filename == self.rsa_path:
+                parsing.set()
+                release.wait(5)
+            return parse(filename, **kwargs)
+
+        with mock.patch.object(paramiko.RSAKey, 'from_private_key_file', side_effect=slow_parse):
+            thread = threading.Thread(target=fsconn.load_private_key, args=(self.rsa_path, 'secret'))
+            thread.start()
+            self.assertTrue(parsing.wait(5))
+            # the RSA key is still being parsed
+            self.assertIsInstance(fsconn.load_private_key(self.ecdsa_path), paramiko.ECDSAKey)
+            release.set()
+            thread.join()
+
+    def test_set_key_uses_cache(self):
+        conn = fsconn.FSConnection()
+        conn.keyfilepath = self.rsa_path
+        conn.passphrase = 'secret'
+        conn.set_rsa_key()
+        self.assertIs(conn._FSConnection__key, fsconn.load_private_key(self.rsa_path, passphrase='secret'))
+
+    def tearDown(self):
+        fsconn.clear_key_cache()
+        self.tmpdir.cleanup()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -97,6 +97,47 @@ def make_dash_figure(plot_content, table_content, table_id, md):
     return figure
 
 
+# create a server-side paged table
+def get_server_side_dash_table(table_id, columns, page_size=10, sort_action='none', filter_action='none',
+                               export=None):
+    """Creates an empty dash_table.DataTable whose pages are loaded by a callback (page_action='custom').
+
+    Use with dbase.KeysetPaginator (MongoDB) or dbase.OBIEETableAdapter (OBIEE, which also supports custom sorting and
+    filtering) so only the visible page is fetched.
+    The callback should take 'page_current' (and 'sort_by'/'filter_query' when sorting or filtering is 'custom') as
+    inputs and return the page 'data' and the 'page_count'.
+
+    :param table_id: The html id of the table, used in callbacks.
+    :param columns: A list of column names.
+    :param page_size: default = 10: The number of rows per page.
+    :param sort_action: default = 'none': 'custom' to let the callback sort the data, 'none' to disable sorting.
+    :param filter_action: default = 'none': 'custom' to let the callback filter the data, 'none' to disable filtering.
+    :param export: default = None: The export format, e.g. 'csv'. Only the visible page is exported.
+    :return: Returns a dash_table.DataTable object.
+    """
+
+    table = dash_table.DataTable(
+        id=table_id,
+        columns=[{'name': i, 'id': i} for i in columns],
+        data=[],
+
+        # let the server supply each page
+        page_action='custom',
+        page_current=0,
+        page_size=page_size,
+        sort_action=sort_action,
+        sort_mode='multi',
+        sort_by=[],
+        filter_action=filter_action,
+        filter_query='',
+
+        export_format=export,
+        style_table={'overflowX': 'auto'}
+    )
+
+    return table
+
+
 # classes
 class DashDF(DataFrame, ABC):
     """Dash dataframe class. This is built on a pandas dataframe and adds some commonly used features for dash apps.
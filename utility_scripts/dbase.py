@@ -2,55 +2,553 @@
 # -*- coding: utf-8 -*-
 
 
-"""The dbase 'Database' module."""
+"""The dbase 'Database' module.
 
+Environment variables:
+
+    MONGO_UPSERT_INDEX
+        - 'create', 'warn' (default) or 'ignore': what the upsert functions do when no index covers the unique_id
+          fields.
+
+    OBIEE_URL, OBIEE_USERNAME, OBIEE_PASSWORD
+        - used by OBIEEConnection(set_env=True).
+"""
+
+import base64
+import bson
+import datetime
+import hashlib
 import jaydebeapi
+import json
+import logging
+import math
+import numpy as np
 import os
 import pandas as pd
-from pymongo import MongoClient
+import re
+import threading
+import time
+import warnings
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager
+from itertools import islice
+from bson import Decimal128, ObjectId, json_util
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from collections import OrderedDict
+from copy import deepcopy
+from pymongo import MongoClient, ReplaceOne, monitoring
+from pymongo.errors import BulkWriteError
 
 
-def get_mongo_client(uri=None, env_var=None, timeout=None):
+def get_mongo_client(uri=None, env_var=None, timeout=None, max_pool_size=None, min_pool_size=None, shared=True,
+                     monitor=False, **kwargs):
     """This function gets and returns a MongoClient object.
     Supply the uri environment variable name to use env_var to get the uri.
+
+    Clients are shared by default: calls with the same uri and options return the same MongoClient from a
+    process-wide registry, so its connection pool and monitor threads are reused. Since other callers may be using
+    it, close() on a shared client (including leaving a with block) does nothing; call close_mongo_clients() at
+    shutdown to close every shared client, or pass shared=False for a private client that close() closes. The
+    registry is reset in child processes after a fork.
+
+    :param uri: the mongo connection string.
+    :param env_var: the name of an environment variable holding the connection string.
+    :param timeout: default None: maxIdleTimeMS for pooled connections.
+    :param max_pool_size: default None (pymongo default of 100): the maximum number of connections per server.
+    :param min_pool_size: default None (pymongo default of 0): the minimum number of connections per server.
+    :param shared: default True: whether to return a shared client from the registry or a new private client.
+    :param monitor: default False: True to record command and connection pool metrics in the module-level
+                    mongo_metrics store, or a MongoMetrics instance to record them in.
+    :param kwargs: any other keyword arguments accepted by MongoClient.
+    :return: returns a MongoClient object.
     """
     if env_var:
         uri = os.getenv(env_var, uri)
     if not uri:
         raise ValueError('You must supply a valid uri string using either the `uri` or `env_var` argument.')
 
-    return MongoClient(uri, maxIdleTimeMS=timeout)
+    options = {'maxIdleTimeMS': timeout}
+    if max_pool_size is not None:
+        options['maxPoolSize'] = max_pool_size
+    if min_pool_size is not None:
+        options['minPoolSize'] = min_pool_size
+    options.update(kwargs)
+    if monitor:
+        listener = mongo_metrics if monitor is True else monitor
+        if not isinstance(listener, MongoMetrics):
+            raise TypeError('monitor must be a boolean or a MongoMetrics instance.')
+        options['event_listeners'] = list(options.get('event_listeners') or []) + [listener]
+
+    if not shared:
+        return MongoClient(uri, **options)
+
+    uri = uri.strip().rstrip('/')
+    key = (uri, tuple(sorted((k, repr(v)) for k, v in options.items())))
+
+    with _MONGO_CLIENTS_LOCK:
+        _check_mongo_clients_pid()
+        entry = _MONGO_CLIENTS.get(key)
+        if entry is None:
+            entry = {'client': _SharedMongoClient(uri, **options), 'uri': uri, 'options': options,
+                     'created': time.time(), 'requests': 0}
+            _MONGO_CLIENTS[key] = entry
+        entry['requests'] += 1
+
+    return entry['client']
+
+
+def close_mongo_clients():
+    """Close every shared MongoClient in the registry and empty the registry. Call this once at shutdown."""
+    with _MONGO_CLIENTS_LOCK:
+        _check_mongo_clients_pid()
+        entries = list(_MONGO_CLIENTS.values())
+        _MONGO_CLIENTS.clear()
+
+    for entry in entries:
+        MongoClient.close(entry['client'])
+
+
+def get_mongo_client_stats():
+    """Return a list of dictionaries describing each shared MongoClient: the uri (with any password redacted), pool
+    sizing, creation time and the number of get_mongo_client calls it has served.
+    """
+    with _MONGO_CLIENTS_LOCK:
+        _check_mongo_clients_pid()
+        entries = list(_MONGO_CLIENTS.values())
+
+    stats = []
+    for entry in entries:
+        pool_options = entry['client'].options.pool_options
+        stats.append({
+            'uri': re.sub(r'(://[^:/@]+):[^@]*@', r'\1:****@', entry['uri']),
+            'max_pool_size': pool_options.max_pool_size,
+            'min_pool_size': pool_options.min_pool_size,
+            'max_idle_time_seconds': pool_options.max_idle_time_seconds,
+            'created': entry['created'],
+            'requests': entry['requests']
+        })
+
+    return stats
+
+
+class _SharedMongoClient(MongoClient):
+    """A MongoClient from the get_mongo_client registry. close() leaves it open for the other callers sharing it,
+    close_mongo_clients() closes it."""
+
+    def close(self):
+        pass
+
+
+# process-wide registry of shared clients {(uri, options): entry}
+_MONGO_CLIENTS = {}
+_MONGO_CLIENTS_LOCK = threading.Lock()
+_MONGO_CLIENTS_PID = os.getpid()
+
+
+def _check_mongo_clients_pid():
+    """Drop clients inherited from a parent process. MongoClient objects are not fork-safe and must not be closed or
+    reused in the child. Must be called while holding _MONGO_CLIENTS_LOCK.
+    """
+    global _MONGO_CLIENTS_PID
+    if _MONGO_CLIENTS_PID != os.getpid():
+        _MONGO_CLIENTS.clear()
+        _MONGO_CLIENTS_PID = os.getpid()
+
+
+def _reset_mongo_clients_after_fork():
+    global _MONGO_CLIENTS_LOCK, _MONGO_CLIENTS_PID
+    _MONGO_CLIENTS_LOCK = threading.Lock()
+    _MONGO_CLIENTS.clear()
+    _MONGO_CLIENTS_PID = os.getpid()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_mongo_clients_after_fork)
+
+
+class MongoMetrics(monitoring.CommandListener, monitoring.ConnectionPoolListener):
+    """An in-process store of Mongo command and connection pool metrics, registered as a pymongo event listener by
+    get_mongo_client(monitor=True).
+
+    Per database, collection and command it records a latency histogram, failures and the number of documents
+    returned or written (and, with track_bytes, the reply size). Per server it records a histogram of the time spent
+    waiting to check out a pooled connection and the checkout failures by reason. Recording is a dictionary update
+    under a lock, so the overhead per command is small.
+
+    Attributes
+    ----------
+        slow_ms:
+            default None: commands slower than this many milliseconds are logged as warnings
+
+        logger:
+            default None: the logger used for slow commands, e.g. from log.create_file_logger(). Defaults to the
+            module logger
+
+        track_bytes:
+            default False: whether to record reply sizes. This re-encodes every reply, so it is off by default
+
+    Methods
+    -------
+        to_dict():
+            returns the metrics as a dictionary
+
+        to_prometheus():
+            returns the metrics in the Prometheus text exposition format
+
+        reset():
+            clears all metrics
+
+    """
+
+    # histogram bucket upper bounds in seconds
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, math.inf)
+
+    def __init__(self, slow_ms=None, logger=None, track_bytes=False):
+        self.slow_ms = slow_ms
+        self.logger = logger
+        self.track_bytes = track_bytes
+        self.__lock = threading.Lock()
+        self.__started = {}
+        self.__checkouts = {}
+        self.reset()
+
+    def reset(self):
+        with self.__lock:
+            self.__commands = {}
+            self.__pools = {}
+
+    # command listener
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if event.command_name == 'getMore':
+            collection = event.command.get('collection')
+        if not isinstance(collection, str):
+            collection = ''
+        self.__started[(event.connection_id, event.request_id)] = (event.database_name, collection,
+                                                                   event.command_name)
+
+    def succeeded(self, event):
+        key = self.__started.pop((event.connection_id, event.request_id), None)
+        if key is None:
+            return
+
+        reply = event.reply
+        docs = reply.get('n', 0) if isinstance(reply.get('n', 0), int) else 0
+        cursor = reply.get('cursor')
+        if isinstance(cursor, dict):
+            docs = len(cursor.get('firstBatch', cursor.get('nextBatch', [])))
+        size = len(bson.encode(reply)) if self.track_bytes else 0
+
+        self.__record(key, event.duration_micros / 1e6, docs, size, failed=False)
+
+    def failed(self, event):
+        key = self.__started.pop((event.connection_id, event.request_id), None)
+        if key is not None:
+            self.__record(key, event.duration_micros / 1e6, 0, 0, failed=True)
+
+    def __record(self, key, seconds, docs, size, failed):
+        with self.__lock:
+            stats = self.__commands.get(key)
+            if stats is None:
+                stats = self.__commands[key] = {'count': 0, 'failures': 0, 'seconds': 0.0, 'documents': 0,
+                                                'bytes': 0, 'buckets': [0] * len(self.BUCKETS)}
+            stats['count'] += 1
+            stats['failures'] += failed
+            stats['seconds'] += seconds
+            stats['documents'] += docs
+            stats['bytes'] += size
+            stats['buckets'][_bucket_index(self.BUCKETS, seconds)] += 1
+
+        if self.slow_ms is not None and seconds * 1000 >= self.slow_ms:
+            database, collection, command = key
+            (self.logger or logging.getLogger(__name__)).warning(
+                f'Slow mongo command {command} on {database}.{collection}: {seconds * 1000:.1f} ms'
+                f'{" (failed)" if failed else ""}.')
+
+    # connection pool listener
+    def connection_check_out_started(self, event):
+        self.__checkouts[(threading.get_ident(), event.address)] = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        started = self.__checkouts.pop((threading.get_ident(), event.address), None)
+        seconds = getattr(event, 'duration', None)
+        if seconds is None:
+            seconds = time.perf_counter() - started if started is not None else 0.0
+
+        with self.__lock:
+            pool = self.__pool(event.address)
+            pool['checkouts'] += 1
+            pool['wait_seconds'] += seconds
+            pool['buckets'][_bucket_index(self.BUCKETS, seconds)] += 1
+
+    def connection_check_out_failed(self, event):
+        self.__checkouts.pop((threading.get_ident(), event.address), None)
+        with self.__lock:
+            failures = self.__pool(event.address)['failures']
+            failures[str(event.reason)] = failures.get(str(event.reason), 0) + 1
+
+    def __pool(self, address):
+        address = f'{address[0]}:{address[1]}' if isinstance(address, tuple) else str(address)
+        pool = self.__pools.get(address)
+        if pool is None:
+            pool = self.__pools[address] = {'checkouts': 0, 'wait_seconds': 0.0, 'failures': {},
+                                            'buckets': [0] * len(self.BUCKETS)}
+        return pool
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
 
+    def connection_ready(self, event):
+        pass
 
-def insert_into_mongo(data, collection):
+    def connection_closed(self, event):
+        pass
+
+    def connection_checked_in(self, event):
+        pass
+
+    # export
+    def to_dict(self):
+        """Return the metrics as {'commands': {'db.collection.command': stats}, 'pools': {'host:port': stats}}, where
+        each 'buckets' entry maps a bucket upper bound in seconds to its (non-cumulative) count.
+        """
+        with self.__lock:
+            commands = {'.'.join(key): dict(stats, buckets=dict(zip(self.BUCKETS, stats['buckets'])))
+                        for key, stats in self.__commands.items()}
+            pools = {address: dict(stats, failures=dict(stats['failures']),
+                                   buckets=dict(zip(self.BUCKETS, stats['buckets'])))
+                     for address, stats in self.__pools.items()}
+
+        return {'commands': commands, 'pools': pools}
+
+    def to_prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        with self.__lock:
+            commands = [(key, dict(stats, buckets=list(stats['buckets']))) for key, stats in self.__commands.items()]
+            pools = [(address, dict(stats, failures=dict(stats['failures']), buckets=list(stats['buckets'])))
+                     for address, stats in self.__pools.items()]
+
+        lines = ['# HELP mongo_command_duration_seconds Mongo command latency.',
+                 '# TYPE mongo_command_duration_seconds histogram']
+        for (database, collection, command), stats in commands:
+            labels = _prometheus_labels(database=database, collection=collection, command=command)
+            lines.extend(_prometheus_histogram('mongo_command_duration_seconds', labels, self.BUCKETS,
+                                               stats['buckets'], stats['seconds'], stats['count']))
+
+        for name, field, description in (('mongo_command_failures_total', 'failures', 'Failed Mongo commands.'),
+                                         ('mongo_command_documents_total', 'documents',
+                                          'Documents returned or written by Mongo commands.'),
+                                         ('mongo_command_reply_bytes_total', 'bytes', 'Mongo reply bytes.')):
+            lines.extend([f'# HELP {name} {description}', f'# TYPE {name} counter'])
+            for (database, collection, command), stats in commands:
+                labels = _prometheus_labels(database=database, collection=collection, command=command)
+                lines.append(f'{name}{{{labels}}} {stats[field]}')
+
+        lines.extend(['# HELP mongo_pool_checkout_wait_seconds Time waiting to check out a pooled connection.',
+                      '# TYPE mongo_pool_checkout_wait_seconds histogram'])
+        for address, stats in pools:
+            lines.extend(_prometheus_histogram('mongo_pool_checkout_wait_seconds', _prometheus_labels(address=address),
+                                               self.BUCKETS, stats['buckets'], stats['wait_seconds'],
+                                               stats['checkouts']))
+
+        lines.extend(['# HELP mongo_pool_checkout_failures_total Failed connection checkouts.',
+                      '# TYPE mongo_pool_checkout_failures_total counter'])
+        for address, stats in pools:
+            for reason, count in stats['failures'].items():
+                labels = _prometheus_labels(address=address, reason=reason)
+                lines.append(f'mongo_pool_checkout_failures_total{{{labels}}} {count}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def _bucket_index(bounds, value):
+    """Return the index of the first histogram bucket whose upper bound is >= value."""
+    for idx, bound in enumerate(bounds):
+        if value <= bound:
+            return idx
+    return len(bounds) - 1
+
+
+def _prometheus_labels(**labels):
+    """Format label names and values for the Prometheus text format."""
+    escaped = {k: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for k, v in labels.items()}
+    return ','.join([f'{k}="{v}"' for k, v in escaped.items()])
+
+
+def _prometheus_histogram(name, labels, bounds, counts, total, count):
+    """Return the cumulative _bucket, _sum and _count lines of a Prometheus histogram."""
+    lines, cumulative = [], 0
+    for bound, bucket_count in zip(bounds, counts):
+        cumulative += bucket_count
+        le = '+Inf' if bound == math.inf else repr(bound)
+        lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+    lines.append(f'{name}_sum{{{labels}}} {total}')
+    lines.append(f'{name}_count{{{labels}}} {count}')
+    return lines
+
+
+# the metrics store used by get_mongo_client(monitor=True)
+mongo_metrics = MongoMetrics()
+
+
+def insert_into_mongo(data, collection, batch_size=None, max_batch_bytes=None, workers=1, ordered=True,
+                      return_ids=False):
     """Insert a python dictionary (one document) or a list of dictionaries (many documents) into a Mongo collection.
 
-    :param data: a dictionary or list of dictionaries to insert into a mongo collection.
+    A pandas dataframe, any other iterable of dictionaries (e.g. a generator), or a list when batch_size,
+    max_batch_bytes or workers is supplied, is streamed into the collection in batches so the full set of documents is
+    never held in memory. Dataframe rows are converted with dataframe_to_documents. Batches
+    can be sent concurrently over a thread pool, sharing the client's connection pool. Errors are collected per batch
+    and the remaining batches are still inserted. With workers > 1 batches may complete in any order.
+
+    :param data: a dictionary, list of dictionaries, iterable of dictionaries or pandas dataframe to insert into a
+                 mongo collection.
     :param collection: a mongo collection object.
-    :return: returns a result object.
+    :param batch_size: default None (1000 when streaming): the maximum number of documents per insert_many call.
+    :param max_batch_bytes: default None: the maximum total BSON size of the documents in a batch.
+    :param workers: default 1: the number of threads used to send batches concurrently.
+    :param ordered: default True: whether the documents in each batch are inserted in order, stopping that batch at
+                    the first error.
+    :param return_ids: default False: whether to collect the inserted _id values when streaming.
+    :return: returns a result object for a dictionary or list, otherwise a summary dictionary with the 'inserted' and
+             'batches' counts, a list of per-batch 'errors' and, if return_ids is True, the 'inserted_ids'.
     """
 
-    if isinstance(data, dict):
+    streaming = any([batch_size is not None, max_batch_bytes is not None, workers != 1])
+
+    if isinstance(data, pd.DataFrame):
+        data = dataframe_to_documents(data, batch_size=batch_size or 1000)
+        result = _stream_into_mongo(data, collection, batch_size or 1000, max_batch_bytes, workers, ordered,
+                                    return_ids)
+    elif isinstance(data, dict):
         result = collection.insert_one(data)
-    elif isinstance(data, list):
+    elif isinstance(data, list) and not streaming:
         result = collection.insert_many(data)
+    elif hasattr(data, '__iter__') and not isinstance(data, (str, bytes)):
+        result = _stream_into_mongo(data, collection, batch_size or 1000, max_batch_bytes, workers, ordered,
+                                    return_ids)
     else:
         raise TypeError('data must be a dictionary or a list of dictionaries.')
 
     return result
 
 
-def upsert_into_mongo(data, unique_id, collection):
+def dataframe_to_documents(df, batch_size=10000):
+    """Lazily generate mongo documents from the rows of a pandas dataframe, a faster and lower memory replacement for
+    df.to_dict('records'). Each batch of rows is converted column by column: NaN, NaT and NA become None, numpy
+    scalars become native python types and timestamps become datetime objects. The index is not included.
+
+    :param df: a pandas dataframe.
+    :param batch_size: default 10000: the number of rows converted at a time.
+    :return: yields one dictionary per row.
+    """
+
+    if not isinstance(df, pd.DataFrame):
+        raise TypeError('df must be a pandas dataframe.')
+
+    names = [str(i) for i in df.columns]
+    for start in range(0, len(df), batch_size):
+        chunk = df.iloc[start:start + batch_size]
+        columns = [_column_to_python(chunk.iloc[:, i]) for i in range(chunk.shape[1])]
+        for row in zip(*columns):
+            yield dict(zip(names, row))
+
+
+def _column_to_python(series):
+    """Convert a dataframe column to a list of bson-encodable python values."""
+
+    missing = series.isna()
+    if pd.api.types.is_datetime64_any_dtype(series):
+        values = list(series.dt.to_pydatetime())
+    else:
+        values = series.astype(object).tolist()
+        if series.dtype == object:
+            values = [v.item() if isinstance(v, np.generic) else v for v in values]
+
+    if missing.any():
+        values = [None if m else v for v, m in zip(values, missing.tolist())]
+
+    return values
+
+
+def _stream_into_mongo(data, collection, batch_size, max_batch_bytes, workers, ordered, return_ids):
+    """Insert an iterable of documents batch by batch, optionally on a thread pool, and summarize the results."""
+
+    if not isinstance(workers, int) or workers < 1:
+        raise ValueError('workers must be a positive integer.')
+
+    summary = {'inserted': 0, 'batches': 0, 'errors': []}
+    if return_ids:
+        summary['inserted_ids'] = []
+
+    def insert_batch(number, batch):
+        if not all([isinstance(i, dict) for i in batch]):
+            raise TypeError('data must be an iterable of dictionaries.')
+        try:
+            result = collection.insert_many(batch, ordered=ordered)
+            return number, len(result.inserted_ids), result.inserted_ids if return_ids else None, None
+        except BulkWriteError as e:
+            inserted = e.details.get('nInserted', 0)
+            # with unordered inserts any document without a write error was inserted
+            failed = {i['index'] for i in e.details.get('writeErrors', [])}
+            ids = [doc['_id'] for idx, doc in enumerate(batch) if idx not in failed][:inserted] if return_ids else None
+            return number, inserted, ids, e.details.get('writeErrors', [])
+
+    def collect(number, inserted, ids, errors):
+        summary['inserted'] += inserted
+        summary['batches'] += 1
+        if errors:
+            summary['errors'].append({'batch': number, 'inserted': inserted, 'write_errors': errors})
+        if return_ids:
+            summary['inserted_ids'].extend(ids)
+
+    batches = enumerate(_batched(data, batch_size, max_batch_bytes))
+
+    if workers == 1:
+        for number, batch in batches:
+            collect(*insert_batch(number, batch))
+        return summary
+
+    # keep a bounded number of batches in flight so the iterable is consumed lazily
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for number, batch in batches:
+            pending.add(executor.submit(insert_batch, number, batch))
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(*future.result())
+        for future in pending:
+            collect(*future.result())
+
+    return summary
+
+
+def upsert_into_mongo(data, unique_id, collection, index=None):
     """This function will insert new records or update (by completely overwriting) existing records. This function
     will NOT update only the provided fields, and will fully overwrite any existing records with matching
     unique_id values.
 
     Records which have matching values specified by the key or list of keys supplied to unique_id.
 
-    :param data: a dictionary or a list of dictionaries to insert or update in mongo db.
+    :param data: a dictionary, a list of dictionaries or a pandas dataframe to insert or update in mongo db.
     :param unique_id: a string or list of strings representing the fields(s) or dictionary key names used as unique
                       identifiers for a record. Supplied values must match dictionary keys and mongo key/field names.
     :param collection: the mongo collection to insert and/or update records.
+    :param index: default None: what to do if no index covers the unique_id fields, see ensure_unique_id_index.
     :return: returns records_to_delete (list of the documents that were deleted (the old records)),
              delete_result (the delete result object), insert_result (the insert result object).
     """
@@ -58,14 +556,12 @@ def upsert_into_mongo(data, unique_id, collection):
     # ensure appropriate data type provided
     if type(data) == dict:
         data = [data]
+    if isinstance(data, pd.DataFrame):
+        data = list(dataframe_to_documents(data))
     if type(data) != list or not all([type(i) == dict for i in data]):
         raise TypeError('data must be supplied as a dictionary or list of dictionaries.')
-    if type(unique_id) == str:
-        unique_id = [unique_id]
-
-    # ensure unique_id is a list and all list items are strings
-    if type(unique_id) != list or not all([type(i) == str for i in unique_id]):
-        raise TypeError('unique_id must be supplied as a string or list of strings.')
+    unique_id = _check_unique_id(unique_id)
+    ensure_unique_id_index(collection, unique_id, action=index)
 
     # check that the unique_id keys exist in each data record
     # add default value of None if it doesn't
@@ -101,6 +597,1388 @@ def upsert_into_mongo(data, unique_id, collection):
     return deleted_records, delete_result, insert_result
 
 
+def bulk_upsert_into_mongo(data, unique_id, collection, batch_size=1000, ordered=False, return_old=False,
+                           index=None, diff=False):
+    """Insert new records or replace (by completely overwriting) existing records using batched bulk writes. Each
+    record is sent as a ReplaceOne(filter, record, upsert=True) operation, so every document is replaced atomically
+    and a batch costs a single round trip instead of one find_one per record.
+
+    In diff mode a content hash of each record (see content_hash) is stored in the CONTENT_HASH_FIELD field, and
+    records whose hash matches the stored document are skipped, so unchanged records cause no writes at all. The
+    stored hashes are fetched with one query per batch.
+
+    The unique_id values should be unique within data. Records with duplicate unique_id values in the same unordered
+    batch are applied in no particular order.
+
+    :param data: a dictionary, an iterable of dictionaries or a pandas dataframe to insert or update in mongo db.
+                 Dataframe rows are converted lazily, one batch at a time, with dataframe_to_documents.
+    :param unique_id: a string or list of strings representing the fields(s) or dictionary key names used as unique
+                      identifiers for a record. Supplied values must match dictionary keys and mongo key/field names.
+    :param collection: the mongo collection to insert and/or update records.
+    :param batch_size: default 1000: the number of operations sent in each bulk_write call.
+    :param ordered: default False: whether each batch is executed in order, stopping at the first error.
+    :param return_old: default False: if True, the existing documents matching the supplied records are fetched with
+                       one query per batch before they are replaced.
+    :param index: default None: what to do if no index covers the unique_id fields, see ensure_unique_id_index.
+    :param diff: default False: whether to skip records whose content is unchanged.
+    :return: returns old_records (list of the documents that were replaced, empty unless return_old is True) and a
+             summary dictionary with the 'matched', 'modified', 'upserted' and 'batches' counts from mongo, plus the
+             'written' (records sent), 'skipped' (unchanged records) and 'new' (records not previously stored)
+             counts.
+    """
+
+    if isinstance(data, dict):
+        data = [data]
+    unique_id = _check_unique_id(unique_id)
+    if not isinstance(batch_size, int) or batch_size < 1:
+        raise ValueError('batch_size must be a positive integer.')
+    if isinstance(data, pd.DataFrame):
+        data = dataframe_to_documents(data, batch_size=batch_size)
+    ensure_unique_id_index(collection, unique_id, action=index)
+
+    old_records = []
+    summary = {'matched': 0, 'modified': 0, 'upserted': 0, 'batches': 0, 'written': 0, 'skipped': 0, 'new': 0}
+
+    for batch in _batched(data, batch_size):
+        if not all([isinstance(i, dict) for i in batch]):
+            raise TypeError('data must be supplied as a dictionary or an iterable of dictionaries.')
+
+        # add default value of None for missing unique_id keys
+        for i in batch:
+            for y in unique_id:
+                i.setdefault(y, None)
+
+        if diff or return_old:
+            # only the keys and stored hashes are needed unless the old documents are returned
+            projection = None if return_old else dict({y: True for y in unique_id}, **{CONTENT_HASH_FIELD: True})
+            existing = list(collection.find(_unique_id_filter(batch, unique_id), projection))
+
+        if diff:
+            stored = {_unique_id_key(i, unique_id): i.get(CONTENT_HASH_FIELD) for i in existing}
+            changed = []
+            for i in batch:
+                # a copy, so the caller's record doesn't gain the hash field
+                i = dict(i, **{CONTENT_HASH_FIELD: content_hash(i)})
+                key = _unique_id_key(i, unique_id)
+                if key not in stored:
+                    summary['new'] += 1
+                    changed.append(i)
+                elif stored[key] != i[CONTENT_HASH_FIELD]:
+                    changed.append(i)
+                else:
+                    summary['skipped'] += 1
+            batch = changed
+
+        if return_old:
+            if diff:
+                written = {_unique_id_key(i, unique_id) for i in batch}
+                existing = [i for i in existing if _unique_id_key(i, unique_id) in written]
+            old_records.extend(existing)
+
+        summary['batches'] += 1
+        if not batch:
+            continue
+
+        requests = [ReplaceOne({y: i[y] for y in unique_id}, i, upsert=True) for i in batch]
+        result = collection.bulk_write(requests, ordered=ordered)
+
+        summary['matched'] += result.matched_count
+        summary['modified'] += result.modified_count
+        summary['upserted'] += result.upserted_count
+        summary['written'] += len(requests)
+        if not diff:
+            summary['new'] += result.upserted_count
+
+    return old_records, summary
+
+
+def ensure_unique_id_index(collection, unique_id, action=None):
+    """Make sure the unique_id lookups of an upsert are index-backed. The check runs once per collection and set of
+    unique_id fields per process; later calls return immediately, except that action='create' checks again if an
+    earlier call only warned.
+
+    Without an index whose leading keys are the unique_id fields, every lookup scans the whole collection.
+
+    :param collection: the mongo collection.
+    :param unique_id: a string or list of strings with the unique_id fields.
+    :param action: default None (the MONGO_UPSERT_INDEX environment variable, or 'warn' if it is not set): one of
+                   'create' (create a compound ascending index on the unique_id fields), 'warn' (issue a warning
+                   with an estimate of the cost) or 'ignore' (skip the check).
+    :return: returns True if an index covers the unique_id fields (or was created), otherwise False.
+    """
+
+    unique_id = _check_unique_id(unique_id)
+    action = action or os.getenv('MONGO_UPSERT_INDEX', 'warn')
+    if action not in ('create', 'warn', 'ignore'):
+        raise ValueError('action must be one of "create", "warn" or "ignore".')
+    if action == 'ignore':
+        return False
+
+    cache_key = (id(collection.database.client), collection.full_name, tuple(unique_id))
+    with _INDEX_CACHE_LOCK:
+        # a missing index is only settled for 'warn', 'create' still has to create it
+        if _INDEX_CACHE.get(cache_key) or (cache_key in _INDEX_CACHE and action != 'create'):
+            return _INDEX_CACHE[cache_key]
+
+    fields = set(unique_id)
+    indexed = any([{i[0] for i in info['key'][:len(unique_id)]} == fields
+                   for info in collection.index_information().values()])
+
+    if not indexed and action == 'create':
+        collection.create_index([(i, 1) for i in unique_id])
+        indexed = True
+    elif not indexed:
+        count = collection.estimated_document_count()
+        warnings.warn(f'No index on {unique_id} in {collection.full_name}. Each upserted record requires a full '
+                      f'collection scan of ~{count:,} documents. Create an index on these fields or pass '
+                      f'index="create".', stacklevel=3)
+
+    with _INDEX_CACHE_LOCK:
+        _INDEX_CACHE[cache_key] = indexed
+
+    return indexed
+
+
+# collections already checked for unique_id indexes {(client id, full name, unique_id): indexed}
+_INDEX_CACHE = {}
+_INDEX_CACHE_LOCK = threading.Lock()
+
+
+# the field used by bulk_upsert_into_mongo(diff=True) to store each document's content hash
+CONTENT_HASH_FIELD = '_content_hash'
+
+
+def content_hash(record):
+    """Return a stable hash of a record's content, ignoring the _id and CONTENT_HASH_FIELD fields. The hash is taken
+    over the BSON encoding of the record with its top level keys sorted (see _canonical), so it does not depend on
+    the order of the fields but does depend on value types (e.g. 1, 1.0 and '1' hash differently), and matches the
+    hash of the stored document. Key order inside embedded documents is kept, since mongo treats {'a': 1, 'b': 2} and
+    {'b': 2, 'a': 1} as different values there.
+    """
+    content = {k: _canonical(record[k]) for k in sorted(record) if k not in ('_id', CONTENT_HASH_FIELD)}
+    return hashlib.sha1(bson.encode(content)).hexdigest()
+
+
+def _unique_id_key(record, unique_id):
+    """Return a hashable key of a record's unique_id values, comparable between records and stored documents."""
+    return bson.encode({'key': _canonical([record.get(y) for y in unique_id])})
+
+
+def _canonical(value):
+    """Return value with datetimes as mongo stores them (naive UTC with millisecond precision), recursively. The key
+    order of dictionaries is kept."""
+    if isinstance(value, dict):
+        return {k: _canonical(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(i) for i in value]
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return datetime.datetime(*value.timetuple()[:6], value.microsecond // 1000 * 1000)
+    return value
+
+
+def _check_unique_id(unique_id):
+    """Return unique_id as a list of strings, raising a TypeError for any other type."""
+    if type(unique_id) == str:
+        unique_id = [unique_id]
+
+    # ensure unique_id is a list and all list items are strings
+    if type(unique_id) != list or not all([type(i) == str for i in unique_id]):
+        raise TypeError('unique_id must be supplied as a string or list of strings.')
+
+    return unique_id
+
+
+def _batched(iterable, batch_size, max_batch_bytes=None):
+    """Yield lists of up to batch_size items from any iterable without materializing the whole iterable. If
+    max_batch_bytes is supplied, batches are also cut before their total BSON size exceeds max_batch_bytes.
+    """
+    iterator = iter(iterable)
+
+    if not max_batch_bytes:
+        while True:
+            batch = list(islice(iterator, batch_size))
+            if not batch:
+                return
+            yield batch
+
+    batch, batch_bytes = [], 0
+    for item in iterator:
+        size = len(bson.encode(item))
+        if batch and (len(batch) >= batch_size or batch_bytes + size > max_batch_bytes):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(item)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+
+def _unique_id_filter(records, unique_id):
+    """Build a single query matching every record's unique_id values ($in for one key, $or for compound keys)."""
+    if len(unique_id) == 1:
+        key = unique_id[0]
+        return {key: {'$in': [i[key] for i in records]}}
+    return {'$or': [{y: i[y] for y in unique_id} for i in records]}
+
+
+def mongo_to_dataframe(collection, filter=None, projection=None, batch_size=10000, dtypes=None, sort=None, limit=0):
+    """Query a Mongo collection and return the results as a pandas dataframe.
+
+    This is a lower memory replacement for pd.DataFrame(list(collection.find(...))). The cursor is converted to
+    columns one batch at a time, so the full list of documents is never held in memory, and each column is converted
+    once: ObjectId values become strings, Decimal128 values become floats and datetime values become datetime64
+    columns. A column is only converted when every non-null value has the type (Decimal128 columns may also hold
+    ints and floats); columns mixing other types are left as object columns so no value is lost. Documents missing a
+    field get a null value in that column.
+
+    :param collection: a mongo collection object.
+    :param filter: default None: the query filter dictionary.
+    :param projection: default None: the projection passed to find().
+    :param batch_size: default 10000: the number of documents returned per cursor batch.
+    :param dtypes: default None: a dictionary of {column: dtype} overriding the inferred column dtypes. Values that
+                   can't be converted to a datetime64 dtype become NaT with a warning.
+    :param sort: default None: a list of (key, direction) pairs passed to find().
+    :param limit: default 0 (no limit): the maximum number of documents to return.
+    :return: returns a pandas dataframe.
+    """
+
+    frames = list(iter_mongo_dataframes(collection, filter=filter, projection=projection, batch_size=batch_size,
+                                        chunk_size=None, dtypes=dtypes, sort=sort, limit=limit))
+
+    return frames[0]
+
+
+def iter_mongo_dataframes(collection, filter=None, projection=None, batch_size=10000, chunk_size=100000,
+                          dtypes=None, sort=None, limit=0):
+    """Query a Mongo collection and yield the results as pandas dataframes of up to chunk_size rows. See
+    mongo_to_dataframe for the column conversions. Only one cursor batch of documents is held as python dictionaries
+    at a time; each batch is converted to columns as soon as it is received.
+
+    :param chunk_size: default 100000: the maximum number of rows per dataframe. None yields a single dataframe.
+    :return: yields pandas dataframes. At least one (possibly empty) dataframe is always yielded.
+    """
+
+    cursor = collection.find(filter or {}, projection, batch_size=batch_size, sort=sort, limit=limit)
+
+    # fields included by the projection are always returned as columns, even if no document has them
+    fields = []
+    if isinstance(projection, dict):
+        fields = [k for k, v in projection.items() if v and not isinstance(v, dict)]
+        if projection.get('_id', True) and '_id' not in fields:
+            fields.insert(0, '_id')
+    elif isinstance(projection, (list, tuple)):
+        fields = ['_id'] + [i for i in projection if i != '_id']
+
+    yielded, exhausted = False, False
+    frames, rows = [], 0
+    while not exhausted:
+        step = min(batch_size, chunk_size - rows) if chunk_size else batch_size
+        batch = list(islice(cursor, step))
+        exhausted = len(batch) < step
+        if batch:
+            frames.append(pd.DataFrame(batch))
+            rows += len(batch)
+
+        if frames and (exhausted or rows == chunk_size):
+            yield _convert_mongo_frame(frames, fields, dtypes)
+            yielded = True
+            frames, rows = [], 0
+
+    if not yielded:
+        yield _convert_mongo_frame([], fields, dtypes)
+
+
+def _convert_mongo_frame(frames, fields, dtypes=None):
+    """Combine dataframes built from batches of mongo documents and convert the bson column types."""
+
+    dtypes = dtypes or {}
+    if len(frames) == 1:
+        df = frames[0]
+    elif frames:
+        df = pd.concat(frames, ignore_index=True)
+    else:
+        df = pd.DataFrame()
+
+    if fields:
+        for field in fields:
+            if field not in df.columns:
+                df[field] = pd.Series([None] * len(df), dtype=object)
+        df = df[fields + [i for i in df.columns if i not in fields]]
+
+    for column in df.columns:
+        series = df[column]
+        if column not in dtypes and series.dtype != object:
+            continue
+
+        # the types of every value, a field may hold different types in different documents
+        types = set(map(type, series[series.notna()]))
+        if types == {ObjectId}:
+            series = series.map(str, na_action='ignore')
+        elif Decimal128 in types and types <= {Decimal128, int, float}:
+            series = series.map(lambda v: float(v.to_decimal()) if isinstance(v, Decimal128) else v,
+                                na_action='ignore').astype('float64')
+        elif types and all([issubclass(i, datetime.datetime) for i in types]):
+            try:
+                series = pd.to_datetime(series)
+            except (ValueError, OverflowError):
+                # e.g. dates outside the datetime64 range, keep them as datetime objects
+                pass
+
+        if column in dtypes:
+            if str(dtypes[column]).startswith('datetime64'):
+                converted = pd.to_datetime(series, errors='coerce')
+                lost = int(converted.isna().sum() - series.isna().sum())
+                if lost:
+                    warnings.warn(f'{lost} values of {column!r} could not be converted to {dtypes[column]} and were '
+                                  f'replaced with NaT.', stacklevel=3)
+                series = converted
+            else:
+                series = series.astype(dtypes[column])
+
+        df[column] = series
+
+    return df
+
+
+class IncrementalMongoFrame:
+    """A cached dataframe of a Mongo query that is refreshed incrementally using a watermark field.
+
+    Each refresh only fetches documents whose watermark field is at or past the highest value already cached, so the
+    cost of a refresh depends on the number of changed documents rather than the size of the collection. The
+    watermark field should be indexed and increase whenever a document is written: an 'updated_at' timestamp picks up
+    inserts and updates, the default '_id' only picks up inserts. Deleted documents are removed by a full reload
+    (reconcile), which runs every reconcile_seconds or when refresh(full=True) is called.
+
+    Attributes
+    ----------
+        collection:
+            the mongo collection object
+
+        filter:
+            the query filter dictionary
+
+        projection:
+            the projection dictionary, the watermark and key fields are always included
+
+        watermark:
+            default '_id': the indexed field used to find new and changed documents
+
+        key:
+            default '_id': the field that uniquely identifies a document, used to replace changed rows
+
+        reconcile_seconds:
+            default 3600: the maximum age of the last full reload before refresh() reloads everything
+
+    Methods
+    -------
+        refresh(full=False):
+            fetches new and changed documents (or everything on a reconcile) and returns a copy of the cached
+            dataframe
+
+    """
+
+    def __init__(self, collection, filter=None, projection=None, watermark='_id', key='_id', reconcile_seconds=3600,
+                 dtypes=None, batch_size=10000):
+        self.collection = collection
+        self.filter = filter or {}
+        self.watermark = watermark
+        self.key = key
+        self.reconcile_seconds = reconcile_seconds
+        self.dtypes = dtypes
+        self.batch_size = batch_size
+
+        # make sure the watermark and key are always returned by an inclusion projection
+        if projection and any([v and not isinstance(v, dict) for k, v in projection.items() if k != '_id']):
+            projection = dict(projection, **{watermark: True, key: True})
+        self.projection = projection
+
+        self.__frame = None
+        self.__watermark_value = None
+        self.__last_reconcile = None
+        self.__lock = threading.Lock()
+
+    @property
+    def df(self):
+        """A copy of the cached dataframe (indexed by the key field), or None before the first refresh."""
+        frame = self.__frame
+        return None if frame is None else frame.copy()
+
+    def refresh(self, full=False):
+        """Fetch new and changed documents and merge them into the cached dataframe.
+
+        :param full: default False: reload the whole query, removing deleted documents from the cache.
+        :return: returns a copy of the cached dataframe, so changes made to it don't affect later merges.
+        """
+        with self.__lock:
+            due = self.__last_reconcile is None or time.time() - self.__last_reconcile >= self.reconcile_seconds
+            if full or due or self.__frame is None or self.__watermark_value is None:
+                self.__reconcile()
+            else:
+                self.__fetch_changes()
+
+            return self.__frame.copy()
+
+    def __reconcile(self):
+        frame = mongo_to_dataframe(self.collection, filter=self.filter, projection=self.projection,
+                                   batch_size=self.batch_size, dtypes=self.dtypes)
+        if self.key not in frame.columns:
+            frame[self.key] = pd.Series(dtype=object)
+        self.__frame = frame.set_index(self.key, drop=False).rename_axis(None)
+        self.__watermark_value = self.__max_watermark(frame)
+        self.__last_reconcile = time.time()
+
+    def __fetch_changes(self):
+        # $gte rather than $gt so documents sharing the current watermark value are not missed
+        since = {self.watermark: {'$gte': self.__watermark_value}}
+        query = {'$and': [self.filter, since]} if self.filter else since
+
+        changes = mongo_to_dataframe(self.collection, filter=query, projection=self.projection,
+                                     batch_size=self.batch_size, dtypes=self.dtypes)
+        if changes.empty:
+            return
+
+        changes = changes.set_index(self.key, drop=False).rename_axis(None)
+        kept = self.__frame.drop(index=changes.index.intersection(self.__frame.index))
+        self.__frame = pd.concat([kept, changes]) if len(kept) else changes
+        self.__watermark_value = self.__max_watermark(changes, self.__watermark_value)
+
+    def __max_watermark(self, frame, default=None):
+        """Return the highest watermark value in frame as a value that can be used in a mongo query."""
+        if self.watermark not in frame.columns or frame[self.watermark].isna().all():
+            return default
+
+        value = frame[self.watermark].max()
+        if isinstance(value, pd.Timestamp):
+            return value.to_pydatetime()
+        if isinstance(value, str) and ObjectId.is_valid(value):
+            return ObjectId(value)
+        if hasattr(value, 'item'):
+            return value.item()
+        return value
+
+
+def get_incremental_frame(collection, filter=None, projection=None, watermark='_id', key='_id',
+                          reconcile_seconds=3600, dtypes=None):
+    """Return the process-wide IncrementalMongoFrame for a query, creating it on first use, so every caller of the
+    same query shares one cached dataframe. Call .refresh() on the result to get the current dataframe.
+
+    See IncrementalMongoFrame for the parameters.
+    """
+    cache_key = (id(collection.database.client), collection.full_name,
+                 json.dumps(filter, sort_keys=True, default=str), json.dumps(projection, sort_keys=True, default=str),
+                 watermark, key)
+
+    with _INCREMENTAL_FRAMES_LOCK:
+        frame = _INCREMENTAL_FRAMES.get(cache_key)
+        if frame is None:
+            frame = IncrementalMongoFrame(collection, filter=filter, projection=projection, watermark=watermark,
+                                          key=key, reconcile_seconds=reconcile_seconds, dtypes=dtypes)
+            _INCREMENTAL_FRAMES[cache_key] = frame
+
+    return frame
+
+
+# process-wide incremental frames {(client id, collection, filter, projection, watermark, key): frame}
+_INCREMENTAL_FRAMES = {}
+_INCREMENTAL_FRAMES_LOCK = threading.Lock()
+
+
+def copy_collection(source, target, filter=None, batch_size=10000, batch_bytes=16 * 1024 * 1024, workers=1,
+                    move=False):
+    """Copy (or move) the documents of one collection into another without decoding them.
+
+    Documents are read as RawBSONDocument objects and inserted as-is, so no BSON is decoded to python dictionaries
+    and re-encoded. Batches are cut by document count and total BSON size. With workers > 1 the _id range is split
+    into that many partitions (with $bucketAuto) which are copied in parallel.
+
+    With move=True each batch is deleted from the source only after its insert has been acknowledged, so an
+    interrupted move can be run again: documents that already exist unchanged in the target (duplicate _id) count as
+    copied. Documents whose _id is in the target with other content count as conflicts and stay in the source, and
+    any other write error (e.g. on a unique secondary index) is raised.
+
+    :param source: the mongo collection to copy from.
+    :param target: the mongo collection to copy to.
+    :param filter: default None: the query filter selecting the documents to copy.
+    :param batch_size: default 10000: the maximum number of documents per insert.
+    :param batch_bytes: default 16MB: the maximum total BSON size of the documents per insert.
+    :param workers: default 1: the number of _id range partitions copied in parallel.
+    :param move: default False: whether to delete the copied documents from the source.
+    :return: returns a summary dictionary with the 'copied', 'deleted', 'conflicts' and 'batches' counts.
+    """
+
+    if not isinstance(workers, int) or workers < 1:
+        raise ValueError('workers must be a positive integer.')
+
+    raw_source = source.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+    filter = filter or {}
+
+    partitions = [filter]
+    if workers > 1:
+        partitions = _id_partitions(source, filter, workers)
+
+    def copy_partition(query):
+        summary = {'copied': 0, 'deleted': 0, 'conflicts': 0, 'batches': 0}
+        batch, size = [], 0
+        for doc in raw_source.find(query, batch_size=batch_size):
+            doc_size = len(doc.raw)
+            if batch and (len(batch) >= batch_size or size + doc_size > batch_bytes):
+                _copy_raw_batch(batch, raw_source, target, move, summary)
+                batch, size = [], 0
+            batch.append(doc)
+            size += doc_size
+        if batch:
+            _copy_raw_batch(batch, raw_source, target, move, summary)
+        return summary
+
+    if len(partitions) == 1:
+        return copy_partition(partitions[0])
+
+    totals = {'copied': 0, 'deleted': 0, 'conflicts': 0, 'batches': 0}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for summary in executor.map(copy_partition, partitions):
+            for key, value in summary.items():
+                totals[key] += value
+
+    return totals
+
+
+def _copy_raw_batch(batch, source, target, move, summary):
+    """Insert a batch of raw documents and, for moves, delete them from the source once the insert is confirmed.
+
+    Only documents that were inserted, or that already exist unchanged in the target (duplicate _id from an earlier,
+    interrupted run), count as copied and are deleted by a move. Documents whose _id exists in the target with other
+    content count as conflicts and are left in the source.
+    """
+    try:
+        target.insert_many(batch, ordered=False)
+        copied = batch
+        conflicts = 0
+    except BulkWriteError as e:
+        errors = e.details.get('writeErrors', [])
+        # anything other than a duplicate _id (e.g. a duplicate on a unique secondary index) is a real error
+        if not all([i.get('code') == 11000 and _is_id_key_error(i) for i in errors]):
+            raise
+        failed = {i['index'] for i in errors}
+        copied = [doc for number, doc in enumerate(batch) if number not in failed]
+
+        # a duplicate _id is only already copied if the target document is identical
+        duplicates = [batch[i] for i in sorted(failed)]
+        raw_target = target.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+        existing = {doc.raw for doc in raw_target.find({'_id': {'$in': [_raw_id(i) for i in duplicates]}})}
+        identical = [doc for doc in duplicates if doc.raw in existing]
+        copied += identical
+        conflicts = len(duplicates) - len(identical)
+
+    summary['copied'] += len(copied)
+    summary['conflicts'] += conflicts
+    summary['batches'] += 1
+    if move and copied:
+        ids = [_raw_id(doc) for doc in copied]
+        summary['deleted'] += source.delete_many({'_id': {'$in': ids}}).deleted_count
+
+
+def _is_id_key_error(error):
+    """Return True if a duplicate key write error is on the _id index."""
+    if 'keyPattern' in error:
+        return error['keyPattern'] == {'_id': 1}
+    # older servers only name the index in the message
+    return ' index: _id_ ' in error.get('errmsg', '')
+
+
+# the sizes of fixed size BSON values by element type, see _raw_id
+_BSON_FIXED_SIZES = {0x01: 8, 0x07: 12, 0x08: 1, 0x09: 8, 0x0A: 0, 0x10: 4, 0x11: 8, 0x12: 8, 0x13: 16}
+
+
+def _raw_id(doc):
+    """Return the _id of a RawBSONDocument, decoding only that element when _id is the first field (as mongo stores
+    it) and is of a common type."""
+    raw = doc.raw
+    kind = raw[4]
+    name_end = raw.index(b'\x00', 5)
+    if raw[5:name_end] == b'_id':
+        start = name_end + 1
+        if kind in _BSON_FIXED_SIZES:
+            end = start + _BSON_FIXED_SIZES[kind]
+        elif kind in (0x02, 0x03, 0x04, 0x05):
+            length = int.from_bytes(raw[start:start + 4], 'little', signed=True)
+            # strings and binaries are prefixed by the length of what follows it, documents include the prefix
+            end = start + length + (4 if kind == 0x02 else 5 if kind == 0x05 else 0)
+        else:
+            end = None
+        if end is not None:
+            # a document holding only the _id element
+            element = raw[4:end]
+            return bson.decode((len(element) + 5).to_bytes(4, 'little') + element + b'\x00')['_id']
+    return bson.decode(raw)['_id']
+
+
+def _id_partitions(collection, filter, partitions):
+    """Split the _id range of the documents matching filter into up to the requested number of query filters."""
+    buckets = list(collection.aggregate([{'$match': filter},
+                                         {'$bucketAuto': {'groupBy': '$_id', 'buckets': partitions}}]))
+    if not buckets:
+        return [filter]
+
+    queries = []
+    for number, bucket in enumerate(buckets):
+        last = number == len(buckets) - 1
+        id_range = {'_id': {'$gte': bucket['_id']['min'], '$lte' if last else '$lt': bucket['_id']['max']}}
+        queries.append({'$and': [filter, id_range]} if filter else id_range)
+
+    return queries
+
+
+# supported aggregation metrics {name: mongo $group accumulator}
+AGGREGATION_OPERATORS = {
+    'sum': '$sum',
+    'mean': '$avg',
+    'avg': '$avg',
+    'min': '$min',
+    'max': '$max',
+    'first': '$first',
+    'last': '$last',
+    'count': '$sum',
+    'nunique': '$addToSet'
+}
+
+
+def build_aggregation_pipeline(filter=None, group_by=None, metrics=None, sort=None, limit=None):
+    """Compile a simple filter/group/sort/top-N specification into a Mongo aggregation pipeline. Compiled pipelines are
+    cached, so repeated calls with the same specification return a copy of the cached pipeline.
+
+    Group keys and metrics are returned as flat fields (dots in group keys are replaced with underscores), so the
+    results convert directly to a dataframe.
+
+    Example: the top 5 regions by total sales in 2021
+        build_aggregation_pipeline(filter={'year': 2021}, group_by='region',
+                                   metrics={'sales': ('sum', 'amount'), 'orders': ('count', None)},
+                                   sort=[('sales', -1)], limit=5)
+
+    :param filter: default None: the query filter dictionary applied before grouping ($match).
+    :param group_by: default None: a field name or list of field names to group by. If metrics are supplied without
+                     group_by, a single row of totals is returned.
+    :param metrics: default None: a dictionary of {output name: (operator, field)}. Operators are the keys of
+                    AGGREGATION_OPERATORS; the field is ignored for 'count'.
+    :param sort: default None: a list of (field, direction) pairs applied to the output fields.
+    :param limit: default None: the maximum number of rows to return.
+    :return: returns the aggregation pipeline as a list of stages.
+    """
+
+    spec = json_util.dumps([filter, group_by, metrics, sort, limit], sort_keys=True)
+    with _PIPELINE_CACHE_LOCK:
+        pipeline = _PIPELINE_CACHE.get(spec)
+        if pipeline is not None:
+            _PIPELINE_CACHE.move_to_end(spec)
+            return deepcopy(pipeline)
+
+    pipeline = _compile_pipeline(filter, group_by, metrics, sort, limit)
+
+    with _PIPELINE_CACHE_LOCK:
+        _PIPELINE_CACHE[spec] = pipeline
+        while len(_PIPELINE_CACHE) > _PIPELINE_CACHE_SIZE:
+            _PIPELINE_CACHE.popitem(last=False)
+
+    return deepcopy(pipeline)
+
+
+def aggregate_to_dataframe(collection, filter=None, group_by=None, metrics=None, sort=None, limit=None,
+                           dtypes=None, allow_disk_use=True):
+    """Run a filter/group/sort/top-N aggregation on the Mongo server and return only the aggregated rows as a pandas
+    dataframe. Use this for summary cards and charts instead of pulling raw documents and grouping in pandas.
+    See build_aggregation_pipeline for the specification and mongo_to_dataframe for the column conversions.
+
+    :param collection: a mongo collection object.
+    :param dtypes: default None: a dictionary of {column: dtype} overriding the inferred column dtypes.
+    :param allow_disk_use: default True: whether large groupings may spill to disk on the server.
+    :return: returns a pandas dataframe with one column per group key and metric.
+    """
+
+    pipeline = build_aggregation_pipeline(filter=filter, group_by=group_by, metrics=metrics, sort=sort, limit=limit)
+    rows = list(collection.aggregate(pipeline, allowDiskUse=allow_disk_use))
+
+    fields = []
+    if metrics:
+        fields = [i.replace('.', '_') for i in _check_group_by(group_by)] + list(metrics)
+
+    return _convert_mongo_frame([pd.DataFrame(rows)] if rows else [], fields, dtypes)
+
+
+def _compile_pipeline(filter, group_by, metrics, sort, limit):
+    """Build the aggregation pipeline stages for build_aggregation_pipeline."""
+
+    group_by = _check_group_by(group_by)
+    if group_by and not metrics:
+        raise ValueError('metrics must be supplied when grouping.')
+
+    pipeline = []
+    if filter:
+        pipeline.append({'$match': filter})
+
+    if metrics:
+        if not isinstance(metrics, dict):
+            raise TypeError('metrics must be a dictionary of {output name: (operator, field)}.')
+
+        keys = {i.replace('.', '_'): f'${i}' for i in group_by}
+        group = {'_id': keys or None}
+        project = {'_id': False}
+        project.update({key: f'$_id.{key}' for key in keys})
+
+        for name, metric in metrics.items():
+            if not isinstance(metric, (tuple, list)) or len(metric) != 2:
+                raise TypeError('each metric must be an (operator, field) pair.')
+            operator, field = metric
+            if operator not in AGGREGATION_OPERATORS:
+                raise ValueError(f'{operator} is not a supported operator. Use one of {list(AGGREGATION_OPERATORS)}.')
+
+            if operator == 'count':
+                group[name] = {'$sum': 1}
+            else:
+                group[name] = {AGGREGATION_OPERATORS[operator]: f'${field}'}
+            project[name] = {'$size': f'${name}'} if operator == 'nunique' else True
+
+        pipeline.append({'$group': group})
+        pipeline.append({'$project': project})
+
+    if sort:
+        pipeline.append({'$sort': dict(sort)})
+    if limit:
+        pipeline.append({'$limit': int(limit)})
+
+    return pipeline
+
+
+def _check_group_by(group_by):
+    """Return group_by as a list of strings, raising a TypeError for any other type."""
+    if group_by is None:
+        return []
+    if isinstance(group_by, str):
+        group_by = [group_by]
+    if not isinstance(group_by, list) or not all([isinstance(i, str) for i in group_by]):
+        raise TypeError('group_by must be supplied as a string or list of strings.')
+    return group_by
+
+
+# compiled aggregation pipelines {specification: pipeline}, least recently used first
+_PIPELINE_CACHE = OrderedDict()
+_PIPELINE_CACHE_SIZE = 256
+_PIPELINE_CACHE_LOCK = threading.Lock()
+
+
+def paginate_collection(collection, filter=None, projection=None, page_size=10, cursor=None, sort_key='_id',
+                        ascending=True, dtypes=None):
+    """Return one page of a query using keyset (range) pagination on an indexed sort key.
+
+    Unlike skip/limit, each page is found with a range query starting at the boundary of the previous page, so every
+    page costs the same index seek regardless of how deep it is. Ties in the sort key are broken by _id, so the sort
+    key should be indexed together with _id (e.g. [(sort_key, 1), ('_id', 1)]) and present in every document.
+
+    :param collection: a mongo collection object.
+    :param filter: default None: the query filter dictionary.
+    :param projection: default None: the projection passed to find(). The sort key and _id are always returned.
+    :param page_size: default 10: the number of rows per page.
+    :param cursor: default None (the first page): a 'next' or 'previous' cursor string returned by an earlier call.
+    :param sort_key: default '_id': the indexed field to page through.
+    :param ascending: default True: the sort direction.
+    :param dtypes: default None: a dictionary of {column: dtype} overriding the inferred column dtypes.
+    :return: returns a dictionary with the page 'data' (a pandas dataframe) and opaque 'next' and 'previous' cursor
+             strings (None when there is no next or previous page).
+    """
+
+    if not isinstance(page_size, int) or page_size < 1:
+        raise ValueError('page_size must be a positive integer.')
+
+    direction, boundary = 'next', None
+    if cursor:
+        direction, boundary = _decode_page_cursor(cursor)
+
+    # going backwards reverses the sort and the range comparison, then the page is put back in order
+    forward = direction == 'next'
+    descending = not ascending if forward else ascending
+    query_filter = dict(filter or {})
+    if boundary is not None:
+        operator = '$lt' if descending else '$gt'
+        if sort_key == '_id':
+            keyset = {'_id': {operator: boundary['i']}}
+        else:
+            keyset = {'$or': [{sort_key: {operator: boundary['k']}},
+                              {sort_key: boundary['k'], '_id': {operator: boundary['i']}}]}
+        query_filter = {'$and': [query_filter, keyset]} if query_filter else keyset
+
+    sort = [(sort_key, -1 if descending else 1)]
+    if sort_key != '_id':
+        sort.append(('_id', -1 if descending else 1))
+
+    if projection and any([v and not isinstance(v, dict) for k, v in projection.items() if k != '_id']):
+        projection = dict(projection, **{sort_key: True, '_id': True})
+    elif projection and projection.get('_id') is False:
+        projection = {k: v for k, v in projection.items() if k != '_id'}
+
+    docs = list(collection.find(query_filter, projection, sort=sort, limit=page_size + 1))
+    more = len(docs) > page_size
+    docs = docs[:page_size]
+    if not forward:
+        docs.reverse()
+
+    next_cursor, previous_cursor = None, None
+    if docs:
+        if more or not forward:
+            next_cursor = _encode_page_cursor('next', docs[-1], sort_key)
+        if (more and not forward) or (forward and boundary is not None):
+            previous_cursor = _encode_page_cursor('previous', docs[0], sort_key)
+
+    data = _convert_mongo_frame([pd.DataFrame(docs)] if docs else [], [], dtypes)
+
+    return {'data': data, 'next': next_cursor, 'previous': previous_cursor}
+
+
+class KeysetPaginator:
+    """Adapts keyset pagination to the page numbers used by a server-side paged dash_table.DataTable
+    (page_action='custom', see dash_tools.get_server_side_dash_table).
+
+    The cursor at each page boundary is remembered, so moving to the next or previous page (or back to any page
+    already visited) costs one index seek. Jumping ahead to a page not yet visited walks forward from the nearest
+    known page.
+
+    Usage in a callback:
+
+        pager = KeysetPaginator(collection, filter={'status': 'open'}, page_size=25)
+
+        @app.callback(Output('table', 'data'), Output('table', 'page_count'), Input('table', 'page_current'))
+        def update_table(page_current):
+            return pager.get_page(page_current).to_dict('records'), pager.page_count()
+
+    Methods
+    -------
+        get_page(page_current):
+            returns the page as a pandas dataframe
+
+        page_count():
+            returns the number of pages (the document count is cached until reset() is called)
+
+        reset():
+            forgets the remembered cursors and count, e.g. after the collection changes
+
+    """
+
+    def __init__(self, collection, filter=None, projection=None, page_size=10, sort_key='_id', ascending=True,
+                 dtypes=None):
+        self.collection = collection
+        self.filter = filter
+        self.projection = projection
+        self.page_size = page_size
+        self.sort_key = sort_key
+        self.ascending = ascending
+        self.dtypes = dtypes
+        self.__cursors = {0: None}
+        self.__count = None
+        self.__lock = threading.Lock()
+
+    def get_page(self, page_current):
+        page_current = page_current or 0
+        with self.__lock:
+            known = max([i for i in self.__cursors if i <= page_current])
+            cursors = dict(self.__cursors)
+
+        page = None
+        for number in range(known, page_current + 1):
+            page = paginate_collection(self.collection, filter=self.filter, projection=self.projection,
+                                       page_size=self.page_size, cursor=cursors[number], sort_key=self.sort_key,
+                                       ascending=self.ascending, dtypes=self.dtypes)
+            if not page['next']:
+                break
+            cursors[number + 1] = page['next']
+
+        with self.__lock:
+            self.__cursors.update(cursors)
+
+        return page['data']
+
+    def page_count(self):
+        with self.__lock:
+            if self.__count is None:
+                self.__count = self.collection.count_documents(self.filter or {})
+            count = self.__count
+        return max(1, -(-count // self.page_size))
+
+    def reset(self):
+        with self.__lock:
+            self.__cursors = {0: None}
+            self.__count = None
+
+
+def _encode_page_cursor(direction, doc, sort_key):
+    """Encode a page boundary (direction, sort key value and _id) as an opaque url-safe string."""
+    text = json_util.dumps({'d': direction, 'k': doc.get(sort_key), 'i': doc['_id']})
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii')
+
+
+def _decode_page_cursor(cursor):
+    """Decode a cursor string made by _encode_page_cursor into (direction, boundary)."""
+    try:
+        boundary = json_util.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        direction = boundary['d']
+    except (ValueError, TypeError, KeyError, AttributeError):
+        raise ValueError('cursor is not a valid page cursor.')
+    if direction not in ('next', 'previous'):
+        raise ValueError('cursor is not a valid page cursor.')
+    return direction, boundary
+
+
+class JDBCConnectionPool:
+    """A thread-safe pool of long-lived DB-API (jaydebeapi) connections.
+
+    Connections are validated on checkout and replaced when they are invalid. Idle connections older than max_lifetime
+    or unused for longer than idle_timeout are closed whenever a connection is checked out or returned. At most size
+    connections are open at a time, counting idle ones; further callers wait for a connection to be returned.
+
+    Attributes
+    ----------
+        size:
+            default 4: the maximum number of open connections
+
+        max_lifetime:
+            default 3600: the maximum age of a connection in seconds
+
+        idle_timeout:
+            default 600: the maximum time in seconds a connection may sit unused in the pool
+
+        checkout_timeout:
+            default None (wait forever): the maximum time in seconds to wait for a free connection
+
+    Methods
+    -------
+        connection():
+            context manager that checks out a connection and returns it to the pool afterwards
+
+        warm_up(n=None):
+            opens up to n (default size) connections ahead of time
+
+        close():
+            closes every idle connection
+
+    """
+
+    def __init__(self, connect, size=4, max_lifetime=3600, idle_timeout=600, checkout_timeout=None,
+                 validation_timeout=5):
+        if not isinstance(size, int) or size < 1:
+            raise ValueError('size must be a positive integer.')
+        self.size = size
+        self.max_lifetime = max_lifetime
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.validation_timeout = validation_timeout
+        self.__connect = connect
+        self.__idle = []
+        # idle and checked out connections
+        self.__open = 0
+        self.__lock = threading.Lock()
+        self.__slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self):
+        if not self.__slots.acquire(timeout=self.checkout_timeout):
+            raise TimeoutError(f'No pooled connection became available within {self.checkout_timeout} seconds.')
+        try:
+            conn, created = self.__checkout()
+            try:
+                yield conn
+            finally:
+                self.__checkin(conn, created)
+        finally:
+            self.__slots.release()
+
+    def warm_up(self, n=None):
+        """Open connections ahead of time so the first queries don't pay for the JVM start and login."""
+        n = min(n or self.size, self.size)
+        while True:
+            with self.__lock:
+                if len(self.__idle) >= n or self.__open >= self.size:
+                    return
+                self.__open += 1
+            self.__checkin(self.__new_connection(), time.monotonic())
+
+    def close(self):
+        with self.__lock:
+            idle, self.__idle = self.__idle, []
+            self.__open -= len(idle)
+        for conn, created, used in idle:
+            _close_quietly(conn)
+
+    def __checkout(self):
+        while True:
+            with self.__lock:
+                stale = self.__prune(time.monotonic())
+                # most recently used first, so rarely used connections expire
+                entry = self.__idle.pop() if self.__idle else None
+                if entry is None:
+                    self.__open += 1
+            for conn in stale:
+                _close_quietly(conn)
+            if entry is None:
+                return self.__new_connection(), time.monotonic()
+
+            conn, created, used = entry
+            if self.__is_valid(conn):
+                return conn, created
+            with self.__lock:
+                self.__open -= 1
+            _close_quietly(conn)
+
+    def __checkin(self, conn, created):
+        now = time.monotonic()
+        with self.__lock:
+            self.__idle.append((conn, created, now))
+            stale = self.__prune(now)
+        for conn in stale:
+            _close_quietly(conn)
+
+    def __new_connection(self):
+        """Connect, for a slot already counted in the open connections."""
+        try:
+            return self.__connect()
+        except BaseException:
+            with self.__lock:
+                self.__open -= 1
+            raise
+
+    def __prune(self, now):
+        """Remove the expired idle connections, and the least recently used ones while more than size are open. Call
+        with the lock held and close the returned connections after releasing it."""
+        def expired(entry):
+            return now - entry[1] > self.max_lifetime or now - entry[2] > self.idle_timeout
+
+        stale = [i for i in self.__idle if expired(i)]
+        self.__idle = [i for i in self.__idle if not expired(i)]
+        while self.__idle and self.__open - len(stale) > self.size:
+            stale.append(self.__idle.pop(0))
+        self.__open -= len(stale)
+        return [i[0] for i in stale]
+
+    def __is_valid(self, conn):
+        jconn = getattr(conn, 'jconn', None)
+        if jconn is None:
+            return True
+        try:
+            return bool(jconn.isValid(self.validation_timeout))
+        except Exception:
+            # some drivers don't implement isValid
+            try:
+                return not jconn.isClosed()
+            except Exception:
+                return False
+
+
+class QueryResultCache:
+    """A thread-safe cache of query results (dataframes) with a per-entry TTL.
+
+    Results are kept in an in-memory LRU of max_entries dataframes and, when directory is supplied, written through to
+    parquet files in directory (requires pyarrow) so they survive restarts and memory evictions. Concurrent callers of
+    get_or_compute for a missing key wait for a single in-flight computation instead of each running the query.
+
+    Attributes
+    ----------
+        max_entries:
+            default 32: the maximum number of dataframes held in memory
+
+        ttl:
+            default 3600: the default time to live of an entry in seconds
+
+        directory:
+            default None: a directory for the on-disk parquet tier, or None for memory only. Results that can't be
+            written as parquet (e.g. duplicate column names or mixed-type object columns) are logged and kept in
+            memory only
+
+    Methods
+    -------
+        get_or_compute(key, compute, ttl=None):
+            returns the cached dataframe for key, or calls compute() once to create it
+
+        get(key):
+            returns the cached dataframe for key, or None
+
+        set(key, df, ttl=None):
+            caches df under key
+
+        invalidate(key=None):
+            removes key, or every entry if key is None
+
+        make_key(query, *parts):
+            returns a cache key for a query, ignoring differences in whitespace outside of string literals
+
+    """
+
+    def __init__(self, max_entries=32, ttl=3600, directory=None):
+        if not isinstance(max_entries, int) or max_entries < 1:
+            raise ValueError('max_entries must be a positive integer.')
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.__memory = OrderedDict()
+        self.__inflight = {}
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def make_key(query, *parts):
+        """Return a hex digest of the normalized query and any other parts of the key (e.g. the url and user)."""
+        # collapse whitespace and drop a trailing semicolon, leaving quoted literals untouched
+        pieces = re.split(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")", query.strip().rstrip(';').strip())
+        normalized = ''.join(p if i % 2 else re.sub(r'\s+', ' ', p) for i, p in enumerate(pieces))
+        return hashlib.sha256(json.dumps([normalized, *map(str, parts)]).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self.__lock:
+            entry = self.__memory.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self.__memory.move_to_end(key)
+                    return entry[0].copy()
+                del self.__memory[key]
+
+        df, expires = self.__read(key, now)
+        if df is None:
+            return None
+        self.__remember(key, df, expires)
+        return df.copy()
+
+    def set(self, key, df, ttl=None):
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        df = df.copy()
+        self.__remember(key, df, expires)
+        self.__write(key, df, expires)
+
+    def get_or_compute(self, key, compute, ttl=None):
+        """Return the cached dataframe for key, or call compute() to create it.
+
+        If another thread is already computing key this waits for its result. Exceptions raised by compute are passed
+        to every waiting caller and nothing is cached.
+
+        :param key: the cache key, see make_key
+        :param compute: a function of no arguments returning a dataframe
+        :param ttl: the time to live of the new entry in seconds, default the ttl attribute
+        """
+        df = self.get(key)
+        if df is not None:
+            return df
+
+        with self.__lock:
+            future = self.__inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.__inflight[key] = future
+        if not leader:
+            return future.result().copy()
+
+        try:
+            # another thread may have finished computing key between the get above and taking the lock
+            df = self.get(key)
+            if df is None:
+                df = compute()
+                self.set(key, df, ttl)
+            future.set_result(df)
+            return df
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.__lock:
+                del self.__inflight[key]
+
+    def invalidate(self, key=None):
+        with self.__lock:
+            if key is None:
+                self.__memory.clear()
+            else:
+                self.__memory.pop(key, None)
+        if self.directory:
+            names = [f'{key}.parquet'] if key else [i for i in os.listdir(self.directory) if i.endswith('.parquet')]
+            for name in names:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+
+    def __remember(self, key, df, expires):
+        with self.__lock:
+            self.__memory[key] = (df, expires)
+            self.__memory.move_to_end(key)
+            while len(self.__memory) > self.max_entries:
+                self.__memory.popitem(last=False)
+
+    def __write(self, key, df, expires):
+        if not self.directory:
+            return
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        path = os.path.join(self.directory, f'{key}.parquet')
+        # write to a per-thread temporary name so readers never see a partial file
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            table = pa.Table.from_pandas(df)
+            table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'expires': str(expires).encode()})
+            pq.write_table(table, tmp_path)
+            os.replace(tmp_path, path)
+        except (pa.ArrowException, ValueError, TypeError, OSError) as e:
+            logging.getLogger(__name__).warning(f'Unable to write query result {key} to the parquet cache: {e!r}')
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def __read(self, key, now):
+        if not self.directory:
+            return None, None
+        import pyarrow.parquet as pq
+
+        path = os.path.join(self.directory, f'{key}.parquet')
+        try:
+            expires = float(pq.read_schema(path).metadata[b'expires'])
+            if expires <= now:
+                os.remove(path)
+                return None, None
+            return pq.read_table(path).to_pandas(), expires
+        except (OSError, KeyError, ValueError, TypeError):
+            # missing, expired by another process or unreadable
+            return None, None
+
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+def _cancel_statement(curs):
+    """Cancel the statement a jaydebeapi cursor is executing, if any (from another thread)."""
+    statement = getattr(curs, '_prep', None)
+    if statement is not None:
+        try:
+            statement.cancel()
+        except Exception:
+            pass
+
+
+def jdbc_rows_to_dataframe(rows, description, category_ratio=None):
+    """Build a dataframe from DB-API rows, converting each column once to a dtype chosen from its JDBC type.
+
+    jaydebeapi returns dates and timestamps as strings and numbers as python objects, which pd.DataFrame(rows) leaves
+    as slow object columns. Here the rows are transposed into columns and each is converted in one vectorized step:
+    dates and timestamps to datetime64, decimals with a scale of 0 and integers to the nullable Int64 dtype, other
+    numbers to float64 and booleans to the nullable boolean dtype. Strings are kept as object columns of the values
+    the driver returned, without inferring a string dtype, unless category_ratio is given (categorical columns behave
+    differently, e.g. in comparisons, groupby and concat, so they are opt-in). A column that can't be converted is
+    left as pandas infers it.
+
+    :param rows: a sequence of row tuples, e.g. from cursor.fetchall()
+    :param description: the cursor.description for the rows
+    :param category_ratio: default None (never use categories): strings become categories if the ratio of distinct
+        values to rows is at most this, e.g. 0.5
+    """
+    columns = [i[0] for i in description]
+    if not rows:
+        # no values to choose from, use the dtypes the JDBC types imply
+        df = pd.DataFrame({i: _empty_jdbc_column(desc) for i, desc in enumerate(description)})
+        df.columns = columns
+        return df
+
+    # one 2d object array is much cheaper to build than pd.DataFrame(rows), which infers every column from objects
+    values = np.array(rows, dtype=object)
+    if values.shape != (len(rows), len(columns)):
+        # a value was itself a sequence
+        values = np.empty((len(rows), len(columns)), dtype=object)
+        for i, row in enumerate(rows):
+            values[i, :] = pd.Series(row, dtype=object).to_numpy()
+
+    converted = {i: _jdbc_column(values[:, i], desc, category_ratio) for i, desc in enumerate(description)}
+    del values
+    # the converted columns are new arrays, copying them again into consolidated blocks would double their memory
+    df = pd.DataFrame(converted, copy=False)
+    df.columns = columns
+    return df
+
+
+def _jdbc_column(values, desc, category_ratio):
+    """Convert an object array of the values of one column to an array with a dtype chosen from its description.
+    values is a view of the array of every column, so the result must not share its memory."""
+    type_code = desc[1]
+    scale = desc[5] if len(desc) > 5 else None
+    try:
+        if type_code is jaydebeapi.DATE or type_code is jaydebeapi.DATETIME:
+            return pd.to_datetime(values, format='ISO8601')
+        if type_code is jaydebeapi.NUMBER or type_code is jaydebeapi.DECIMAL or type_code is jaydebeapi.FLOAT:
+            # NUMBER covers BOOLEAN and BIT as well as the integer types
+            sample = next((v for v in values if v is not None), None)
+            if isinstance(sample, bool):
+                return pd.array(values, dtype='boolean')
+            if isinstance(sample, int) and (type_code is jaydebeapi.NUMBER or
+                                            (type_code is jaydebeapi.DECIMAL and scale == 0)):
+                mask = np.equal(values, None)
+                data = values.copy()
+                data[mask] = 0
+                return pd.arrays.IntegerArray(data.astype('int64'), mask)
+            # None becomes nan
+            return values.astype('float64')
+        if (type_code is jaydebeapi.STRING or type_code is jaydebeapi.TEXT) and category_ratio is not None:
+            # skip hashing the whole column when a sample already has too many distinct values
+            sample = values[:10000]
+            if len(pd.unique(sample)) <= category_ratio * len(sample):
+                codes, categories = pd.factorize(values)
+                if len(categories) <= category_ratio * len(values):
+                    return pd.Categorical.from_codes(codes, categories)
+        if type_code is jaydebeapi.STRING or type_code is jaydebeapi.TEXT:
+            return pd.Series(values.copy(), dtype=object)
+    except (TypeError, ValueError, OverflowError):
+        pass
+    return pd.Series(values.copy()).infer_objects()
+
+
+def _empty_jdbc_column(desc):
+    """Return an empty array with the dtype _jdbc_column chooses for a column of desc holding non-null values."""
+    type_code = desc[1]
+    scale = desc[5] if len(desc) > 5 else None
+    if type_code is jaydebeapi.NUMBER or (type_code is jaydebeapi.DECIMAL and scale == 0):
+        return pd.array([], dtype='Int64')
+    return _jdbc_column(np.empty(0, dtype=object), desc, None)
+
+
+def _chunk_dtypes(df):
+    """Return the dtypes of a first result chunk, widened so that later chunks with nulls still fit them."""
+    dtypes = {}
+    for col, dtype in df.dtypes.items():
+        if pd.api.types.is_bool_dtype(dtype):
+            dtypes[col] = 'boolean'
+        elif pd.api.types.is_integer_dtype(dtype):
+            dtypes[col] = 'Int64'
+        else:
+            dtypes[col] = dtype
+    return dtypes
+
+
+def _conform_chunk(df, dtypes):
+    """Cast the columns of a result chunk to dtypes, raising a ValueError if a column can't be cast."""
+    for col, dtype in dtypes.items():
+        if col in df.columns and df[col].dtype != dtype:
+            try:
+                df[col] = df[col].astype(dtype)
+            except (TypeError, ValueError, OverflowError) as e:
+                raise ValueError(f'Column {col!r} of a result chunk can not be cast to {dtype}, the dtype of the '
+                                 f'first chunk. Supply its dtype with dtypes.') from e
+    return df
+
+
+def _check_chunk_size(chunk_size):
+    """Raise a ValueError unless chunk_size is a positive integer."""
+    if not isinstance(chunk_size, int) or isinstance(chunk_size, bool) or chunk_size < 1:
+        raise ValueError('chunk_size must be a positive integer.')
+
+
 class OBIEEConnection:
     """OBIEE connection object.
 
@@ -118,10 +1996,45 @@ class OBIEEConnection:
         __driver_args:
             dictionary of strings supplying the 'user' and 'password'
 
+        convert_types:
+            default True: convert result columns to dtypes chosen from their JDBC types (see jdbc_rows_to_dataframe),
+            False for the dtypes pd.DataFrame infers from the rows
+
+        category_ratio:
+            default None: with convert_types, the ratio of distinct values to rows at or below which string columns
+            become categories (see jdbc_rows_to_dataframe), None to leave them as strings
+
     Methods
     -------
-    submit_query:
-        submits the supplied query to OBIEE and returns a pandas dataframe
+    submit_query(query, ttl=None, refresh=False):
+        submits the supplied query to OBIEE and returns a pandas dataframe, from the cache if enabled
+
+    submit_queries(queries, max_workers=None, timeout=None, ttl=None):
+        submits several queries concurrently and returns ({name: dataframe}, {name: exception})
+
+    enable_cache(max_entries=32, ttl=3600, directory=None, cache=None):
+        caches query results in memory and optionally on disk (see QueryResultCache)
+
+    disable_cache():
+        stops caching query results
+
+    invalidate_cache(query=None):
+        removes the cached result of the query, or all cached results
+
+    enable_pool(size=4, max_lifetime=3600, idle_timeout=600, checkout_timeout=None):
+        reuse long-lived connections (see JDBCConnectionPool) instead of connecting for every query
+
+    warm_up(n=None):
+        starts the JVM and opens the pooled connections, call at app start
+
+    close_pool():
+        closes the pooled connections and returns to connecting for every query
+
+    iter_query(query, chunk_size=50000, dtypes=None):
+        submits the supplied query and yields dataframes of at most chunk_size rows with the same dtypes
+
+    query_to_parquet(query, path, chunk_size=50000, dtypes=None):
+        streams the results of the supplied query to a parquet file on local disk and returns the number of rows
 
     """
 
@@ -144,6 +2057,10 @@ class OBIEEConnection:
                 'user': None,
                 'password': None
             }
+        self.__pool = None
+        self.__cache = None
+        self.convert_types = True
+        self.category_ratio = None
 
     @property
     def driver_args(self):
@@ -162,19 +2079,394 @@ class OBIEEConnection:
         else:
             raise TypeError('driver_args must be a dictionary with string values for "user" and "password".')
 
-    def submit_query(self, query):
-        with jaydebeapi.connect(
-                jclassname=self.java_driver_class,
-                url=self.url,
-                driver_args=self.__driver_args,
-                jars=self.jar) as conn:
+    def enable_pool(self, size=4, max_lifetime=3600, idle_timeout=600, checkout_timeout=None):
+        self.close_pool()
+        self.__pool = JDBCConnectionPool(self.__connect, size=size, max_lifetime=max_lifetime,
+                                         idle_timeout=idle_timeout, checkout_timeout=checkout_timeout)
+
+    def warm_up(self, n=None):
+        if not self.__pool:
+            raise AttributeError('Call the .enable_pool() method before calling .warm_up().')
+        self.__pool.warm_up(n)
+
+    def close_pool(self):
+        if self.__pool:
+            self.__pool.close()
+        self.__pool = None
+
+    def __connect(self):
+        return jaydebeapi.connect(
+            jclassname=self.java_driver_class,
+            url=self.url,
+            driver_args=self.__driver_args,
+            jars=self.jar)
+
+    @contextmanager
+    def _connection(self):
+        """Yield a pooled connection, or a new connection that is closed afterwards if pooling is not enabled."""
+        if self.__pool:
+            with self.__pool.connection() as conn:
+                yield conn
+        else:
+            with self.__connect() as conn:
+                yield conn
+
+    def enable_cache(self, max_entries=32, ttl=3600, directory=None, cache=None):
+        """Cache the results of submit_query, see QueryResultCache. Supply cache to share one between connections."""
+        self.__cache = cache if cache is not None else QueryResultCache(max_entries=max_entries, ttl=ttl,
+                                                                         directory=directory)
+
+    def disable_cache(self):
+        self.__cache = None
+
+    def invalidate_cache(self, query=None):
+        """Remove the cached result of query, or every cached result if query is None."""
+        if self.__cache:
+            self.__cache.invalidate(self.__cache_key(query) if query is not None else None)
+
+    def __cache_key(self, query):
+        # the user is part of the key since OBIEE may return different rows to different users
+        return QueryResultCache.make_key(query, self.url, self.__driver_args.get('user'), self.convert_types,
+                                         self.category_ratio)
+
+    def submit_query(self, query, ttl=None, refresh=False):
+        """Submit the query and return the results as a dataframe.
+
+        If the cache is enabled, results are cached by query (ignoring whitespace), url and user.
+
+        :param query: the query to submit
+        :param ttl: seconds to cache the result for, default the cache's ttl, 0 to bypass the cache
+        :param refresh: run the query even if its result is cached and cache the new result
+        """
+        return self.__submit(query, ttl, refresh)
+
+    def submit_queries(self, queries, max_workers=None, timeout=None, ttl=None):
+        """Submit several independent queries at once and return (results, errors).
+
+        The queries run on a thread pool, over pooled connections if enable_pool has been called, so the total time
+        approaches that of the slowest query. A query that fails or runs past its timeout doesn't affect the others:
+        results holds a dataframe for each query that succeeded and errors the exception for each query that didn't
+        (TimeoutError for timeouts). Running queries that time out are cancelled where the driver allows it.
+
+        :param queries: a {name: query} dict
+        :param max_workers: the number of queries run at a time, default the pool size (or 4 without a pool)
+        :param timeout: seconds each query may run, or a {name: seconds} dict, default None (no timeout)
+        :param ttl: passed to submit_query for every query
+        """
+        if not isinstance(queries, dict):
+            raise TypeError('queries must be a dictionary of {name: query}.')
+        results, errors = {}, {}
+        if not queries:
+            return results, errors
+        if max_workers is None:
+            max_workers = self.__pool.size if self.__pool else 4
+        max_workers = min(max_workers, len(queries))
+        timeouts = timeout if isinstance(timeout, dict) else {name: timeout for name in queries}
+
+        cursors = {}
+
+        def run(name, query):
+            return self.__submit(query, ttl, False, lambda curs: cursors.__setitem__(name, curs))
+
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='obiee-query')
+        try:
+            futures = {executor.submit(run, name, query): name for name, query in queries.items()}
+            # timeouts count from submission, queued queries included
+            start = time.monotonic()
+            deadlines = {name: start + timeouts[name] for name in queries if timeouts.get(name) is not None}
+            pending = set(futures)
+            while pending:
+                remaining = [deadlines[futures[f]] - time.monotonic() for f in pending if futures[f] in deadlines]
+                done, pending = wait(pending, timeout=max(0, min(remaining)) if remaining else None,
+                                     return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = futures[future]
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        errors[name] = e
+                for future in list(pending):
+                    name = futures[future]
+                    if name in deadlines and time.monotonic() >= deadlines[name]:
+                        pending.discard(future)
+                        future.cancel()
+                        _cancel_statement(cursors.get(name))
+                        errors[name] = TimeoutError(f'Query {name!r} did not finish within {timeouts[name]} seconds.')
+        finally:
+            # don't wait for timed out queries that couldn't be cancelled
+            executor.shutdown(wait=False)
+        return results, errors
+
+    def __submit(self, query, ttl=None, refresh=False, on_cursor=None):
+        if not self.__cache or ttl == 0:
+            return self.__run_query(query, on_cursor)
+        key = self.__cache_key(query)
+        if refresh:
+            self.__cache.invalidate(key)
+        return self.__cache.get_or_compute(key, lambda: self.__run_query(query, on_cursor), ttl=ttl)
+
+    def __run_query(self, query, on_cursor=None):
+        with self._connection() as conn:
             with conn.cursor() as curs:
+                if on_cursor:
+                    on_cursor(curs)
                 curs.execute(query)
                 dat = curs.fetchall()
                 col_info = curs.description
 
+        return self.__to_dataframe(dat, col_info, category_ratio=self.category_ratio)
+
+    def __to_dataframe(self, dat, col_info, category_ratio=None):
+        if self.convert_types:
+            return jdbc_rows_to_dataframe(dat, col_info, category_ratio=category_ratio)
+
         # get a list of columns
         columns = [i[0] for i in col_info]
 
         df = pd.DataFrame(dat, columns=columns)
         return df
+
+    def iter_query(self, query, chunk_size=50000, dtypes=None):
+        """Submit the query and yield the results as dataframes of at most chunk_size rows.
+
+        Only one chunk of rows is held at a time, so large extracts run in bounded memory. Every chunk has the dtypes
+        of the first chunk, with integer and boolean columns widened to the nullable Int64 and boolean dtypes so that
+        nulls in later chunks don't change them. Supply dtypes as a {column: dtype} dict to set them explicitly.
+
+        The connection is held until the generator is exhausted or closed. A ValueError is raised if a later chunk
+        can't be cast to the dtypes of the first, e.g. text in a column whose first chunk held only numbers.
+
+        :param query: the query to submit
+        :param chunk_size: the number of rows fetched from OBIEE and yielded per dataframe
+        :param dtypes: optional {column: dtype} dict of dtypes used in place of those inferred from the first chunk
+        """
+        # validated here rather than when the generator starts
+        _check_chunk_size(chunk_size)
+        return self.__iter_query(query, chunk_size, dtypes)
+
+    def __iter_query(self, query, chunk_size, dtypes, empty=False):
+        """Yield the result chunks of iter_query, or a single empty chunk with the result columns if empty is True
+        and the query returns no rows."""
+        dtypes = dict(dtypes) if dtypes else None
+
+        with self._connection() as conn:
+            with conn.cursor() as curs:
+                curs.execute(query)
+                description = curs.description
+                chunks = 0
+                while True:
+                    dat = curs.fetchmany(chunk_size)
+                    if not dat:
+                        break
+                    # no categories, their categories would differ between chunks
+                    df = self.__to_dataframe(dat, description, category_ratio=None)
+                    del dat
+                    if dtypes is None:
+                        dtypes = _chunk_dtypes(df)
+                    chunks += 1
+                    yield _conform_chunk(df, dtypes)
+                if empty and not chunks:
+                    df = self.__to_dataframe([], description)
+                    yield _conform_chunk(df, dtypes or _chunk_dtypes(df))
+
+    def query_to_parquet(self, query, path, chunk_size=50000, dtypes=None):
+        """Stream the results of the query to a parquet file, one row group per chunk, and return the number of rows.
+
+        Requires pyarrow. The file is written to a temporary name and renamed when complete, so a failed extract never
+        leaves a partial file at path. If the query returns no rows the file holds just the result columns, typed from
+        their JDBC types. Read the file back with pd.read_parquet(path), or pd.read_parquet(path, columns=[...]) to
+        load only some of the columns.
+
+        :param query: the query to submit
+        :param path: the path of the parquet file to write
+        :param chunk_size: the number of rows fetched from OBIEE and written per row group
+        :param dtypes: optional {column: dtype} dict, see iter_query
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        _check_chunk_size(chunk_size)
+        tmp_path = f'{path}.tmp'
+        writer = None
+        rows = 0
+        try:
+            for df in self.__iter_query(query, chunk_size, dtypes, empty=True):
+                if writer is None:
+                    # columns that are entirely null in the first chunk are stored as strings
+                    schema = pa.Schema.from_pandas(df, preserve_index=False)
+                    schema = pa.schema([pa.field(f.name, pa.string()) if pa.types.is_null(f.type) else f
+                                        for f in schema], metadata=schema.metadata)
+                    writer = pq.ParquetWriter(tmp_path, schema)
+                if len(df):
+                    writer.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False))
+                rows += len(df)
+            writer.close()
+            writer = None
+            os.replace(tmp_path, path)
+        finally:
+            if writer is not None:
+                writer.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return rows
+
+
+class OBIEETableAdapter:
+    """Serves the pages of a server-side paged dash_table.DataTable (page_action='custom', see
+    dash_tools.get_server_side_dash_table) from an OBIEE query.
+
+    The query is wrapped in an outer query carrying the DataTable's filter_query as a WHERE clause, its sort_by as an
+    ORDER BY clause and the page as OFFSET/FETCH, so OBIEE returns only the visible page. The order_by columns follow
+    sort_by in the ORDER BY clause so rows keep the same order from page to page; by default they are every column of
+    the query, read once with a one row query. The row count for page_count is queried once per filter and cached
+    until reset() is called.
+
+    Filters use the DataTable filter syntax, e.g. '{region} = east && {amount} >= 100', with the operators =, !=, <,
+    <=, >, >= (or eq, ne, lt, le, gt, ge), contains, datestartswith and 'is blank', each optionally prefixed with i
+    for case insensitive matching or s for case sensitive matching.
+
+    Usage in a callback:
+
+        adapter = OBIEETableAdapter(conn, 'SELECT "Sales"."Region" region, "Sales"."Amount" amount FROM "Sales"')
+
+        @app.callback(Output('table', 'data'), Output('table', 'page_count'), Input('table', 'page_current'),
+                      Input('table', 'sort_by'), Input('table', 'filter_query'))
+        def update_table(page_current, sort_by, filter_query):
+            page = adapter.get_page(page_current, sort_by, filter_query)
+            return page.to_dict('records'), adapter.page_count(filter_query)
+
+    Attributes
+    ----------
+        connection:
+            the OBIEEConnection used to submit the queries
+
+        query:
+            the logical SQL query to page through
+
+        page_size:
+            default 10: the number of rows per page
+
+        columns:
+            default None: a {column id: SQL expression} dict for columns whose id isn't the column name of the query,
+            otherwise columns are referenced by their quoted id
+
+        order_by:
+            default None (every column of the query): a list of column ids that identify a row, used to order the
+            rows after sort_by
+
+    Methods
+    -------
+        get_page(page_current, sort_by=None, filter_query=None):
+            returns the page as a pandas dataframe
+
+        page_count(filter_query=None):
+            returns the number of pages (the row count is cached per filter until reset() is called)
+
+        build_query(page_current, sort_by=None, filter_query=None):
+            returns the logical SQL submitted for the page
+
+        reset():
+            forgets the cached row counts, e.g. after the data changes
+
+    """
+
+    def __init__(self, connection, query, page_size=10, columns=None, order_by=None):
+        self.connection = connection
+        self.query = query.strip().rstrip(';')
+        self.page_size = page_size
+        self.columns = columns or {}
+        self.order_by = order_by
+        self.__counts = {}
+        self.__lock = threading.Lock()
+
+    def get_page(self, page_current, sort_by=None, filter_query=None):
+        return self.connection.submit_query(self.build_query(page_current, sort_by, filter_query))
+
+    def page_count(self, filter_query=None):
+        where = self.__where(filter_query)
+        with self.__lock:
+            count = self.__counts.get(where)
+        if count is None:
+            df = self.connection.submit_query(f'SELECT COUNT(*) FROM ({self.query}) t{where}')
+            count = int(df.iloc[0, 0])
+            with self.__lock:
+                self.__counts[where] = count
+        return max(1, -(-count // self.page_size))
+
+    def build_query(self, page_current, sort_by=None, filter_query=None):
+        page_current = page_current or 0
+        sort_by = sort_by or []
+        # without a total order OBIEE may return the rows of consecutive pages in different orders
+        sorted_ids = {i['column_id'] for i in sort_by}
+        order_by = [f'{self.__column(i["column_id"])} {"DESC" if i.get("direction") == "desc" else "ASC"}'
+                    for i in sort_by]
+        order_by += [f'{self.__column(i)} ASC' for i in self.__order_by() if i not in sorted_ids]
+        return (f'SELECT * FROM ({self.query}) t{self.__where(filter_query)} ORDER BY {", ".join(order_by)} '
+                f'OFFSET {page_current * self.page_size} ROWS FETCH NEXT {self.page_size} ROWS ONLY')
+
+    def reset(self):
+        with self.__lock:
+            self.__counts = {}
+
+    def __order_by(self):
+        with self.__lock:
+            if self.order_by is not None:
+                return self.order_by
+        df = self.connection.submit_query(f'SELECT * FROM ({self.query}) t OFFSET 0 ROWS FETCH NEXT 1 ROWS ONLY')
+        with self.__lock:
+            if self.order_by is None:
+                self.order_by = list(df.columns)
+            return self.order_by
+
+    def __column(self, column_id):
+        if column_id in self.columns:
+            return self.columns[column_id]
+        return '"' + str(column_id).replace('"', '""') + '"'
+
+    def __where(self, filter_query):
+        conditions = [self.__condition(part) for part in (filter_query or '').split(' && ') if part.strip()]
+        return f' WHERE {" AND ".join(conditions)}' if conditions else ''
+
+    def __condition(self, part):
+        match = _FILTER_PART.match(part.strip())
+        if not match:
+            raise ValueError(f'Unsupported filter: {part!r}.')
+        column = self.__column(match['column'].replace('\\}', '}'))
+        case, operator = match['case'], _FILTER_OPERATORS.get(match['operator'], match['operator'])
+        value = match['value']
+
+        if operator == 'is blank':
+            return f'({column} IS NULL OR CAST({column} AS VARCHAR(4000)) = \'\')'
+        if value is None:
+            raise ValueError(f'Unsupported filter: {part!r}.')
+        quoted = value[:1] in ('"', "'", '`') and value[-1:] == value[:1] and len(value) > 1
+        if quoted:
+            value = re.sub(r'\\(.)', r'\1', value[1:-1])
+
+        if operator == 'contains':
+            condition, column, literal = 'LIKE', column, _sql_literal(f'%{value}%')
+        elif operator == 'datestartswith':
+            condition, column, literal = 'LIKE', f'CAST({column} AS VARCHAR(30))', _sql_literal(f'{value}%')
+        else:
+            condition, literal = operator, _sql_literal(value, number=not quoted)
+        if case == 'i':
+            column, literal = f'UPPER({column})', f'UPPER({literal})'
+        return f'{column} {condition} {literal}'
+
+
+# {column} [i|s]operator [value], see OBIEETableAdapter
+_FILTER_PART = re.compile(
+    r'^\{(?P<column>(?:[^}\\]|\\.)+)\}\s*(?P<case>[is]?)'
+    r'(?P<operator>>=|<=|!=|=|<|>|eq|ne|lt|le|gt|ge|contains|datestartswith|is blank)'
+    r'(?:\s+(?P<value>.+))?$')
+
+_FILTER_OPERATORS = {'eq': '=', 'ne': '!=', 'lt': '<', 'le': '<=', 'gt': '>', 'ge': '>='}
+
+_SQL_NUMBER = re.compile(r'^-?\d+(\.\d+)?([eE][-+]?\d+)?$')
+
+
+def _sql_literal(value, number=False):
+    """Return value as a SQL literal: a number if number is True and it parses as one, otherwise a quoted string."""
+    if number and _SQL_NUMBER.match(value):
+        return value
+    return "'" + str(value).replace("'", "''") + "'"
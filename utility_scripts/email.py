@@ -7,6 +7,14 @@ Classes:
 
     Mail: SMTP email class.
 
+    StreamingMessage: a MIME message whose attachments are encoded as it's sent.
+
+    SMTPSession: sends many messages over one SMTP connection (see Mail.session and Mail.send_batch).
+
+    MailQueue: delivers messages in the background (see Mail.start_queue).
+
+    MailSpool: delivers messages in the background from a SQLite file that survives restarts (see Mail.start_spool).
+
     Error, InvalidEmailFormatError (used for validation) of the Mail class.
 
 
@@ -15,13 +23,24 @@ Functions:
     validate_email(email_address)
 """
 
+import base64
+import copy
+import heapq
+import itertools
+import json
+import mimetypes
 import os
+import queue
 import re
 import smtplib
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import Future
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
-from email import encoders
 
 
 # custom Error classes
@@ -53,20 +72,44 @@ def validate_email(email_address):
         raise TypeError('Email addresses must be strings.')
 
 
+def _validate_addresses(value):
+    """Returns a list of email addresses from a string or list of strings, raising if any has an invalid format."""
+
+    addresses = [value] if isinstance(value, str) else value
+    if not isinstance(addresses, (list, tuple)):
+        raise TypeError('Email addresses must be a string or a list of strings.')
+    for address in addresses:
+        if not validate_email(address):
+            raise InvalidEmailFormatError(f'{address} is not a valid email address format.')
+    return list(addresses)
+
+
 class Mail:
     """The Mail class contains attributes and methods associated with sending SMTP emails.
 
     Attributes
     ----------
         __attachment:
-            The file path for an attachment.
+            The file path for an attachment, or a list of them. Attachments are read and base64 encoded in chunks as
+            the message is sent, so memory use doesn't grow with their size.
+
+        __bcc:
+            Validated as having a valid email format: A list of email addresses to blind copy. They're left out of the
+            message headers.
 
         __body:
             Validated as a string. Text to use for the email body.
 
+        __cc:
+            Validated as having a valid email format: A list of email addresses to copy.
+
         host:
             The SMTP email host to send the email.
 
+        __max_recipients:
+            Default 100: The most recipients the server accepts per message (RCPT commands). Messages to more
+            recipients are sent to each chunk of this many in turn, over the same connection.
+
         __password:
             (Optional): The password if needed for TLS protocol.
 
@@ -74,7 +117,7 @@ class Mail:
             Default 25: The port for the SMTP host.
 
         __recipient:
-            Validated as having a valid email format: The email address of the email recipient.
+            Validated as having a valid email format: The email address of the email recipient, or a list of them.
 
         __sender:
             Validated as having a valid email format: The email address of the email sender.
@@ -93,7 +136,26 @@ class Mail:
     Methods
     -------
         send_mail():
-            Sends an email to from the sender to the recipient set in the Mail object.
+            Sends an email to from the sender to the recipient set in the Mail object, or queues it if start_queue()
+            or start_spool() has been called.
+
+        start_queue(workers=2, max_size=1000, retries=3, backoff=1):
+            Makes send_mail() return right away, delivering messages in the background (see MailQueue).
+
+        start_spool(path, workers=1, batch_size=100, retries=5, backoff=1):
+            Like start_queue(), but messages are kept in a SQLite file until sent (see MailSpool).
+
+        stop_queue(timeout=None):
+            Delivers the queued messages and stops the queue or spool.
+
+        session(max_messages=None):
+            Returns an SMTPSession to send many messages over one connection.
+
+        send_batch(messages, max_messages=None):
+            Sends a message per dictionary of attribute values over one connection and returns the outcome of each.
+
+        envelope_recipients():
+            Returns every recipient address (recipient, cc and bcc) without duplicates.
 
     """
 
@@ -101,6 +163,9 @@ class Mail:
 
         self.__sender = os.getenv('MAIL_SENDER')
         self.__recipient = os.getenv('MAIL_RECIPIENT')
+        self.__cc = []
+        self.__bcc = []
+        self.__max_recipients = 100
         self.__body = os.getenv('MAIL_BODY')
         self.__port = os.getenv('MAIL_PORT', 25)
         self.__password = os.getenv('MAIL_PASSWORD')
@@ -109,6 +174,7 @@ class Mail:
         self.__host = os.getenv('MAIL_SERVER')
         self.__username = os.getenv('MAIL_USERNAME')
         self.__tls = os.getenv('MAIL_TLS', False)
+        self.__queue = None
 
     # define protected properties
     # sender property
@@ -130,11 +196,50 @@ class Mail:
 
     @recipient.setter
     def recipient(self, value):
-        if validate_email(value):
+        if isinstance(value, (list, tuple)):
+            self.__recipient = _validate_addresses(value)
+        elif validate_email(value):
             self.__recipient = value
         else:
             raise InvalidEmailFormatError(f'{value} is not a valid email address format.')
 
+    # cc property
+    @property
+    def cc(self):
+        return self.__cc
+
+    @cc.setter
+    def cc(self, value):
+        self.__cc = _validate_addresses(value)
+
+    # bcc property
+    @property
+    def bcc(self):
+        return self.__bcc
+
+    @bcc.setter
+    def bcc(self, value):
+        self.__bcc = _validate_addresses(value)
+
+    # max_recipients property
+    @property
+    def max_recipients(self):
+        return self.__max_recipients
+
+    @max_recipients.setter
+    def max_recipients(self, value):
+        if isinstance(value, int) and not isinstance(value, bool) and value > 0:
+            self.__max_recipients = value
+        else:
+            raise TypeError(f'max_recipients must be a positive integer. You entered {value}.')
+
+    def envelope_recipients(self):
+        """Returns the list of every recipient address (recipient, cc and bcc) without duplicates."""
+
+        recipient = self.__recipient or []
+        recipients = [recipient] if isinstance(recipient, str) else list(recipient)
+        return list(dict.fromkeys(recipients + self.__cc + self.__bcc))
+
     # body validation
     @property
     def body(self):
@@ -166,16 +271,17 @@ class Mail:
 
     @attachment.setter
     def attachment(self, value):
-        if isinstance(value, str):
-            if os.path.exists(value):
-                if os.path.isfile(value):
-                    self.__attachment = value
+        paths = value if isinstance(value, (list, tuple)) and value else [value]
+        for path in paths:
+            if isinstance(path, str):
+                if os.path.exists(path):
+                    if not os.path.isfile(path):
+                        raise FileNotFoundError(f'File {path} not found at specified path.')
                 else:
-                    raise FileNotFoundError(f'File {value} not found at specified path.')
+                    raise FileNotFoundError(f'Unable to locate path. Current working directory is {os.getcwd()}.')
             else:
-                raise FileNotFoundError(f'Unable to locate path. Current working directory is {os.getcwd()}.')
-        else:
-            raise TypeError('attachment must be a string file path.')
+                raise TypeError('attachment must be a string file path or a list of them.')
+        self.__attachment = value if isinstance(value, str) else list(value)
 
     @property
     def username(self):
@@ -239,11 +345,112 @@ class Mail:
     def send_mail(self):
         """The mail object properties must all be valid prior to calling this method.
 
-        Sends an SMTP email using the defined attributes of the mail object."""
+        Sends an SMTP email using the defined attributes of the mail object, and returns a dictionary of the
+        recipients the server refused, {address: (code, response)}. If start_queue() has been called the
+        message is queued instead and a concurrent.futures.Future of its delivery is returned right away, or if
+        start_spool() has been called the message is stored in the spool and its spool id is returned."""
+
+        if self.__queue:
+            return self.__queue.put(self._build_message(), self.__sender, self.envelope_recipients())
+
+        with self.session() as session:
+            return session.send()
+
+    def start_queue(self, workers=2, max_size=1000, retries=3, backoff=1):
+        """Makes send_mail() queue messages for background delivery (see MailQueue) instead of sending them.
+
+        The connection settings (host, port, tls, username and password) are fixed when the queue starts.
+
+        :param workers: default 2: The number of delivery threads (and SMTP connections).
+        :param max_size: default 1000: The maximum number of queued messages, send_mail() waits when it's reached.
+        :param retries: default 3: The number of times transient (4xx or connection) failures are retried.
+        :param backoff: default 1: Seconds before the first retry, doubling for each retry after it.
+        :return: The MailQueue.
+        """
+
+        self.stop_queue()
+        self.__queue = MailQueue(copy.copy(self), workers=workers, max_size=max_size, retries=retries,
+                                 backoff=backoff)
+        return self.__queue
+
+    def start_spool(self, path, workers=1, batch_size=100, retries=5, backoff=1):
+        """Makes send_mail() store messages in a SQLite spool file for background delivery (see MailSpool) and return
+        their spool id. Unlike start_queue(), queued messages survive a crash or restart and are sent when the spool
+        is next started.
+
+        The connection settings (host, port, tls, username and password) are fixed when the spool starts.
+
+        :param path: The path of the SQLite spool file, created if it doesn't exist.
+        :param workers: default 1: The number of delivery threads (and SMTP connections).
+        :param batch_size: default 100: The maximum number of messages a worker claims at a time.
+        :param retries: default 5: The number of times transient (4xx or connection) failures are retried.
+        :param backoff: default 1: Seconds before the first retry, doubling for each retry after it.
+        :return: The MailSpool.
+        """
+
+        self.stop_queue()
+        self.__queue = MailSpool(copy.copy(self), path, workers=workers, batch_size=batch_size, retries=retries,
+                                 backoff=backoff)
+        return self.__queue
+
+    def stop_queue(self, timeout=None):
+        """Delivers the queued messages and stops the queue (or spool), call at shutdown. send_mail() sends directly
+        again.
+
+        :param timeout: default None: The maximum number of seconds to wait for queued messages.
+        :return: False if messages were still queued when timeout expired (they fail with RuntimeError, or stay in
+            the spool to be sent when it's next started).
+        """
+
+        drained = True
+        if self.__queue:
+            drained = self.__queue.stop(timeout)
+        self.__queue = None
+        return drained
+
+    def session(self, max_messages=None):
+        """Returns an SMTPSession that sends any number of messages over one authenticated connection.
+
+        Usage:
+
+            with mail.session() as session:
+                for address in addresses:
+                    session.send(recipient=address)
+
+        :param max_messages: default None: reconnect after this many messages, for servers that limit them per
+            connection.
+        """
+
+        return SMTPSession(self, max_messages=max_messages)
+
+    def send_batch(self, messages, max_messages=None):
+        """Sends many messages over one connection and returns the outcome of each.
+
+        Each message is a dictionary of the Mail attributes that differ from this Mail object, e.g.
+        {'recipient': 'someone@domain.com', 'body': 'Hello.'}. A message that fails doesn't stop the others.
+
+        :param messages: An iterable of dictionaries of attribute values.
+        :param max_messages: default None: see session().
+        :return: A list with a dictionary per message: {'sent': bool, 'refused': {recipient: (code, response)},
+            'error': the exception raised or None}.
+        """
+
+        outcomes = []
+        with self.session(max_messages=max_messages) as session:
+            for message in messages:
+                try:
+                    refused = session.send(**message)
+                    outcomes.append({'sent': True, 'refused': refused, 'error': None})
+                except (Error, smtplib.SMTPException, OSError, AttributeError, TypeError) as e:
+                    outcomes.append({'sent': False, 'refused': getattr(e, 'recipients', {}), 'error': e})
+        return outcomes
+
+    def _validate(self):
+        """Raises AttributeError if an attribute needed to send an email is missing."""
 
         if not self.__sender:
             raise AttributeError('The "sender" attribute must be set to send an email.')
-        if not self.__recipient:
+        if not self.__recipient and not self.__cc and not self.__bcc:
             raise AttributeError('The "recipient" attribute must be set to send an email.')
         if not self.__subject:
             raise AttributeError('The "subject" attribute must be set to send an email.')
@@ -257,40 +464,650 @@ class Mail:
             if not self.__username or not self.__password:
                 raise AttributeError('The "username" and "password" attributes must be set to send TLS emails.')
 
+    def _build_message(self):
+        """Validates the attributes and returns the StreamingMessage to send."""
+
+        self._validate()
+
         # define the message
         message = MIMEMultipart()
         message['From'] = self.__sender
-        message['To'] = self.__recipient
+        if self.__recipient:
+            message['To'] = self.__recipient if isinstance(self.__recipient, str) else ', '.join(self.__recipient)
+        if self.__cc:
+            message['Cc'] = ', '.join(self.__cc)
         message['Subject'] = self.__subject
         message.attach(MIMEText(self.__body, 'plain'))
 
-        # format and set the attachment if present
-        if self.__attachment:
-            # set the filename
-            if '\\' in self.__attachment:
-                self.__attachment.replace('\\', '/')
-            if '/' in self.__attachment:
-                idx = self.__attachment.rfind('/') + 1
-                filename = self.__attachment[idx:]
-            else:
-                filename = self.__attachment
-
-            # read in the attachment
-            with open(self.__attachment, 'rb') as file:
-                payload = MIMEBase('application', 'octate-stream')
-                payload.set_payload(file.read())
-                encoders.encode_base64(payload)
-                payload.add_header('Content-Disposition', 'attachment', filename=filename)
-                message.attach(payload)
-
-        with smtplib.SMTP(self.__host, self.__port) as smtp:
-            if self.tls:
-                if not self.__username or not self.__password:
-                    raise AttributeError(
-                        'The "username" and "password" attributes must be set to send TLS emails.')
+        attachments = [self.__attachment] if isinstance(self.__attachment, str) else self.__attachment or []
+        return StreamingMessage(message, attachments)
+
+    def _connect(self):
+        """Returns an SMTP connection to the host, logged in if TLS is used."""
+
+        smtp = smtplib.SMTP(self.__host, self.__port)
+        try:
+            if self.__tls:
                 smtp.starttls()
                 smtp.login(self.__username, self.__password)
-            text = message.as_string()
-            smtp.sendmail(self.__sender, self.__recipient, text)
+        except BaseException:
             smtp.close()
-            smtp.quit()
+            raise
+        return smtp
+
+
+class StreamingMessage:
+    """A MIME message whose attachments are read and base64 encoded in chunks as it's written, see Mail._build_message.
+
+    The headers and text parts come from a MIMEMultipart message; each attachment is added as a part with a MIME type
+    guessed from its file name.
+
+    Attributes
+    ----------
+        message:
+            The MIMEMultipart message holding the headers and text parts.
+
+        attachments:
+            A list of attachment file paths.
+
+    Methods
+    -------
+        chunks(smtp=True):
+            Yields the message as bytes, in chunks of a bounded size. With smtp=True lines end with CRLF and lines
+            starting with '.' are escaped, ready for the SMTP DATA command.
+
+        as_string():
+            Returns the whole message as a string (reading every attachment into memory).
+
+    """
+
+    # raw bytes per chunk, a multiple of the 57 bytes encoded on each 76 character base64 line
+    CHUNK_SIZE = 57 * 1024
+
+    def __init__(self, message, attachments=None):
+        self.message = message
+        self.attachments = list(attachments or [])
+
+    def __getitem__(self, name):
+        return self.message[name]
+
+    def chunks(self, smtp=True):
+        linesep = '\r\n' if smtp else '\n'
+        policy = self.message.policy.clone(linesep=linesep)
+        boundary = self.message.get_boundary()
+        if boundary is None:
+            boundary = f'==============={uuid.uuid4().hex}=='
+            self.message.set_boundary(boundary)
+        end = f'--{boundary}--'.encode()
+
+        # the headers and text parts, without the closing boundary
+        head = self.message.as_bytes(policy=policy)
+        head = head[:head.rindex(end)]
+        yield _dot_stuff(head) if smtp else head
+
+        for path in self.attachments:
+            content_type, encoding = mimetypes.guess_type(path)
+            if content_type is None or encoding is not None:
+                content_type = 'application/octet-stream'
+            part = MIMEBase(*content_type.split('/', 1))
+            part['Content-Transfer-Encoding'] = 'base64'
+            part.add_header('Content-Disposition', 'attachment',
+                            filename=os.path.basename(path.replace('\\', '/')))
+            yield f'--{boundary}{linesep}'.encode() + part.as_bytes(policy=policy)
+
+            with open(path, 'rb') as file:
+                while True:
+                    data = file.read(self.CHUNK_SIZE)
+                    if not data:
+                        break
+                    # base64 never starts a line with '.'
+                    yield base64.encodebytes(data).replace(b'\n', linesep.encode())
+
+        yield end + linesep.encode()
+
+    def as_string(self):
+        return b''.join(self.chunks(smtp=False)).decode('utf-8', 'surrogateescape')
+
+
+def _dot_stuff(data):
+    """Escapes lines starting with '.' for the SMTP DATA command."""
+
+    return re.sub(rb'(?m)^\.', b'..', data)
+
+
+class SMTPSession:
+    """Sends messages built from a Mail object over one SMTP connection, reconnecting when the server drops it.
+
+    Create with Mail.session(). The connection is opened by the first send and closed by close() or on leaving a with
+    block.
+
+    Attributes
+    ----------
+        mail:
+            The Mail object the messages and connection settings come from.
+
+        max_messages:
+            Default None: reconnect after this many messages, for servers that limit them per connection.
+
+        sent:
+            The number of messages sent.
+
+    Methods
+    -------
+        send(**attributes):
+            Sends a message built from the Mail object, with any attributes given (e.g. recipient=...) replaced.
+            Returns a dictionary of refused recipients, like smtplib.SMTP.sendmail.
+
+        send_message(message, sender, recipients):
+            Sends a message that has already been built.
+
+        close():
+            Quits the connection.
+
+    """
+
+    def __init__(self, mail, max_messages=None):
+        self.mail = mail
+        self.max_messages = max_messages
+        self.sent = 0
+        self.__smtp = None
+        self.__count = 0
+
+    def send(self, **attributes):
+        mail = self.mail
+        if attributes:
+            # set the attributes on a copy so they're validated without changing the Mail object
+            mail = copy.copy(mail)
+            for name, value in attributes.items():
+                if not isinstance(getattr(type(mail), name, None), property):
+                    raise AttributeError(f'Mail has no attribute {name!r}.')
+                setattr(mail, name, value)
+        message = mail._build_message()
+        return self.send_message(message, mail.sender, mail.envelope_recipients())
+
+    def send_message(self, message, sender, recipients):
+        """Sends a message that has already been built (a StreamingMessage, MIME message or string), see
+        Mail._build_message. A StreamingMessage is written to the connection chunk by chunk.
+
+        The recipients are sent to in chunks of at most mail.max_recipients. Returns a dictionary of the refused
+        recipients, and raises SMTPRecipientsRefused only if every recipient was refused."""
+
+        # only messages with attachments are worth streaming
+        if not isinstance(message, str) and not getattr(message, 'attachments', None):
+            message = message.as_string()
+        if isinstance(recipients, str):
+            recipients = [recipients]
+        size = self.mail.max_recipients
+
+        refused = {}
+        for i in range(0, len(recipients), size):
+            try:
+                refused.update(self.__sendmail(sender, recipients[i:i + size], message))
+            except smtplib.SMTPRecipientsRefused as e:
+                # every recipient in this chunk was refused, carry on with the others
+                refused.update(e.recipients)
+        if recipients and len(refused) == len(recipients):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        return refused
+
+    def __sendmail(self, sender, recipients, message):
+        for attempt in range(2):
+            if self.max_messages and self.__count >= self.max_messages:
+                self.close()
+            if self.__smtp is None:
+                self.__smtp = self.mail._connect()
+                self.__count = 0
+            try:
+                if isinstance(message, StreamingMessage):
+                    refused = _stream_mail(self.__smtp, sender, recipients, message)
+                else:
+                    refused = self.__smtp.sendmail(sender, recipients, message)
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPResponseException) as e:
+                # the server timed out or closed the connection (421), retry once on a new connection
+                if isinstance(e, smtplib.SMTPResponseException) and e.smtp_code != 421:
+                    raise
+                self.__drop()
+                if attempt:
+                    raise
+                continue
+            except smtplib.SMTPRecipientsRefused as e:
+                # a 421 reply to RCPT means the server closed the connection part way through the chunk, so the
+                # recipients after it were never tried: retry the chunk once, then refuse all of it
+                closing = [i for i in e.recipients.values() if i[0] == 421]
+                if not closing:
+                    raise
+                self.__drop()
+                if attempt:
+                    raise smtplib.SMTPRecipientsRefused({i: closing[0] for i in recipients})
+                continue
+            self.__count += 1
+            self.sent += 1
+            return refused
+
+    def close(self):
+        if self.__smtp is not None:
+            try:
+                self.__smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                self.__smtp.close()
+            self.__smtp = None
+
+    def __drop(self):
+        self.__smtp.close()
+        self.__smtp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class MailQueue:
+    """Delivers messages in the background so sending doesn't block the caller, e.g. a Dash callback.
+
+    Create with Mail.start_queue(). Messages are built when they're queued and delivered by worker threads, each
+    keeping its own SMTPSession open while there is mail to send. Transient failures (4xx replies, dropped or refused
+    connections) are retried with exponential backoff; other failures are final.
+
+    Attributes
+    ----------
+        workers:
+            Default 2: The number of delivery threads (and SMTP connections).
+
+        max_size:
+            Default 1000: The maximum number of queued messages, put() waits for space when the queue is full.
+
+        retries:
+            Default 3: The number of times a transient failure is retried.
+
+        backoff:
+            Default 1: Seconds before the first retry, doubling for each retry after it.
+
+        max_backoff:
+            Default 300: The maximum number of seconds between retries.
+
+        idle_timeout:
+            Default 60: A worker closes its connection after this many seconds without mail to send.
+
+    Methods
+    -------
+        put(message, sender, recipients, block=True, timeout=None):
+            Queues a built message and returns a concurrent.futures.Future of its delivery, whose result is the
+            dictionary of refused recipients. Cancelling the future before its first delivery attempt skips the
+            message.
+
+        drain(timeout=None):
+            Waits until every queued message has been delivered or has failed. Returns False if timeout expired.
+
+        stop(timeout=None):
+            Drains the queue, then stops the workers and closes their connections.
+
+    """
+
+    def __init__(self, mail, workers=2, max_size=1000, retries=3, backoff=1, max_backoff=300, idle_timeout=60):
+        if not isinstance(workers, int) or workers < 1:
+            raise ValueError('workers must be a positive integer.')
+        self.mail = mail
+        self.workers = workers
+        self.max_size = max_size
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.idle_timeout = idle_timeout
+        # (time to send, sequence number, item) ordered by time to send
+        self.__heap = []
+        self.__sequence = itertools.count()
+        self.__unfinished = 0
+        self.__running = True
+        self.__condition = threading.Condition()
+        self.__threads = [threading.Thread(target=self.__work, name=f'mail-queue-{i}', daemon=True)
+                          for i in range(workers)]
+        for thread in self.__threads:
+            thread.start()
+
+    def put(self, message, sender, recipients, block=True, timeout=None):
+        if not isinstance(message, str):
+            message = message.as_string()
+        future = Future()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.__condition:
+            if not self.__running:
+                raise RuntimeError('The mail queue has been stopped.')
+            while self.__unfinished >= self.max_size:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if not block or (remaining is not None and remaining <= 0):
+                    raise queue.Full('The mail queue is full.')
+                self.__condition.wait(remaining)
+            self.__push(time.monotonic(), {'message': message, 'sender': sender, 'recipients': recipients,
+                                           'future': future, 'attempts': 0})
+            self.__unfinished += 1
+        return future
+
+    def drain(self, timeout=None):
+        with self.__condition:
+            return self.__condition.wait_for(lambda: self.__unfinished == 0, timeout)
+
+    def stop(self, timeout=None):
+        drained = self.drain(timeout)
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify_all()
+        for thread in self.__threads:
+            thread.join()
+
+        # fail anything left when timeout expired
+        with self.__condition:
+            heap, self.__heap = self.__heap, []
+            self.__unfinished -= len(heap)
+        for when, sequence, item in heap:
+            if item['future'].cancelled():
+                continue
+            item['future'].set_exception(RuntimeError('The mail queue was stopped before the message was sent.'))
+        return drained
+
+    def __push(self, when, item):
+        heapq.heappush(self.__heap, (when, next(self.__sequence), item))
+        self.__condition.notify_all()
+
+    def __next(self):
+        """Waits for the next message that is due, or returns None after idle_timeout or when stopping."""
+        with self.__condition:
+            while True:
+                if not self.__running:
+                    return None
+                now = time.monotonic()
+                if self.__heap and self.__heap[0][0] <= now:
+                    return heapq.heappop(self.__heap)[2]
+                wait = self.__heap[0][0] - now if self.__heap else self.idle_timeout
+                if not self.__condition.wait(wait) and not self.__heap:
+                    return None
+
+    def __work(self):
+        session = SMTPSession(self.mail)
+        try:
+            while self.__running:
+                item = self.__next()
+                if item is None:
+                    # idle (or stopping), don't hold the connection open
+                    session.close()
+                    continue
+                if not item['attempts'] and not item['future'].set_running_or_notify_cancel():
+                    # cancelled while it was queued
+                    self.__finish()
+                    continue
+                self.__deliver(session, item)
+        finally:
+            session.close()
+
+    def __deliver(self, session, item):
+        try:
+            refused = session.send_message(item['message'], item['sender'], item['recipients'])
+        except Exception as e:
+            if _is_transient(e) and item['attempts'] < self.retries:
+                delay = min(self.backoff * 2 ** item['attempts'], self.max_backoff)
+                item['attempts'] += 1
+                with self.__condition:
+                    self.__push(time.monotonic() + delay, item)
+                return
+            item['future'].set_exception(e)
+        else:
+            item['future'].set_result(refused)
+        self.__finish()
+
+    def __finish(self):
+        with self.__condition:
+            self.__unfinished -= 1
+            self.__condition.notify_all()
+
+
+def _stream_mail(smtp, sender, recipients, message):
+    """Sends a StreamingMessage like smtplib.SMTP.sendmail, writing it to the socket chunk by chunk."""
+
+    smtp.ehlo_or_helo_if_needed()
+    code, response = smtp.mail(sender)
+    if code != 250:
+        _abort(smtp, code)
+        raise smtplib.SMTPSenderRefused(code, response, sender)
+
+    refused = {}
+    for recipient in recipients:
+        code, response = smtp.rcpt(recipient)
+        if code not in (250, 251):
+            refused[recipient] = (code, response)
+        if code == 421:
+            smtp.close()
+            raise smtplib.SMTPRecipientsRefused(refused)
+    if len(refused) == len(recipients):
+        _abort(smtp, 0)
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    smtp.putcmd('data')
+    code, response = smtp.getreply()
+    if code != 354:
+        _abort(smtp, code)
+        raise smtplib.SMTPDataError(code, response)
+    for chunk in message.chunks(smtp=True):
+        smtp.send(chunk)
+    smtp.send(b'.\r\n')
+    code, response = smtp.getreply()
+    if code != 250:
+        _abort(smtp, code)
+        raise smtplib.SMTPDataError(code, response)
+    return refused
+
+
+def _abort(smtp, code):
+    """Resets the transaction after a failed command, or closes the connection if the server is closing it (421)."""
+
+    if code == 421:
+        smtp.close()
+    else:
+        try:
+            smtp.rset()
+        except smtplib.SMTPServerDisconnected:
+            pass
+
+
+def _is_transient(error):
+    """Returns True for SMTP failures worth retrying: 4xx replies and connection problems."""
+
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        # temporary only if every recipient was refused with a 4xx reply
+        return all(400 <= code < 500 for code, response in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, OSError))
+
+
+class MailSpool:
+    """Delivers messages in the background from a SQLite spool file, so queued mail survives a crash or restart.
+
+    Create with Mail.start_spool(). put() stores the built message and commits (one local fsync) before returning its
+    id. Worker threads claim due messages in batches, send them over their own SMTPSession and record every attempt
+    and the final status ('sent' or 'failed') in the spool. Messages still 'sending' when the process stopped are sent
+    again when the spool is next opened, so delivery is at least once. Transient failures are retried as in MailQueue.
+
+    One process should own a spool file at a time.
+
+    Attributes
+    ----------
+        path:
+            The path of the SQLite spool file, created if it doesn't exist.
+
+        workers:
+            Default 1: The number of delivery threads (and SMTP connections).
+
+        batch_size:
+            Default 100: The maximum number of messages a worker claims at a time.
+
+        retries, backoff, max_backoff, idle_timeout:
+            As in MailQueue.
+
+    Methods
+    -------
+        put(message, sender, recipients):
+            Stores a built message and returns its id.
+
+        status(message_id):
+            Returns a dictionary of the status, attempts and last error of a message, or None.
+
+        pending():
+            Returns the number of messages not yet sent or failed.
+
+        drain(timeout=None):
+            Waits until every message has been sent or has failed. Returns False if timeout expired.
+
+        purge(older_than=604800):
+            Deletes sent and failed messages last updated more than older_than seconds ago.
+
+        stop(timeout=None):
+            Drains the spool, then stops the workers. Messages still queued are sent when the spool is next opened.
+
+    """
+
+    def __init__(self, mail, path, workers=1, batch_size=100, retries=5, backoff=1, max_backoff=300,
+                 idle_timeout=60):
+        if not isinstance(workers, int) or workers < 1:
+            raise ValueError('workers must be a positive integer.')
+        self.mail = mail
+        self.path = path
+        self.workers = workers
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.idle_timeout = idle_timeout
+
+        # one connection shared by the threads, used under __db_lock
+        self.__db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.__db_lock = threading.Lock()
+        with self.__db_lock:
+            self.__db.execute('PRAGMA journal_mode=WAL')
+            self.__db.execute('PRAGMA synchronous=FULL')
+            self.__db.execute('CREATE TABLE IF NOT EXISTS spool (id INTEGER PRIMARY KEY, sender TEXT, recipients TEXT, '
+                              'message TEXT, status TEXT, attempts INTEGER DEFAULT 0, next_attempt REAL, '
+                              'error TEXT, created REAL, updated REAL)')
+            self.__db.execute('CREATE INDEX IF NOT EXISTS spool_due ON spool (status, next_attempt)')
+            # recover messages claimed by workers that didn't finish
+            self.__db.execute("UPDATE spool SET status = 'queued' WHERE status = 'sending'")
+
+        self.__running = True
+        # the number of put() calls, so a worker can tell whether a message arrived since its last claim
+        self.__puts = 0
+        self.__condition = threading.Condition()
+        self.__threads = [threading.Thread(target=self.__work, name=f'mail-spool-{i}', daemon=True)
+                          for i in range(workers)]
+        for thread in self.__threads:
+            thread.start()
+
+    def put(self, message, sender, recipients):
+        if not isinstance(message, str):
+            message = message.as_string()
+        if not self.__running:
+            raise RuntimeError('The mail spool has been stopped.')
+        now = time.time()
+        with self.__db_lock:
+            cursor = self.__db.execute(
+                "INSERT INTO spool (sender, recipients, message, status, next_attempt, created, updated) "
+                "VALUES (?, ?, ?, 'queued', ?, ?, ?)", (sender, json.dumps(recipients), message, now, now, now))
+        with self.__condition:
+            self.__puts += 1
+            self.__condition.notify_all()
+        return cursor.lastrowid
+
+    def status(self, message_id):
+        with self.__db_lock:
+            row = self.__db.execute('SELECT status, attempts, error, created, updated FROM spool WHERE id = ?',
+                                    (message_id,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(['status', 'attempts', 'error', 'created', 'updated'], row))
+
+    def pending(self):
+        with self.__db_lock:
+            return self.__db.execute("SELECT COUNT(*) FROM spool WHERE status IN ('queued', 'sending')").fetchone()[0]
+
+    def drain(self, timeout=None):
+        with self.__condition:
+            return self.__condition.wait_for(lambda: self.pending() == 0, timeout)
+
+    def purge(self, older_than=604800):
+        with self.__db_lock:
+            self.__db.execute("DELETE FROM spool WHERE status IN ('sent', 'failed') AND updated < ?",
+                              (time.time() - older_than,))
+
+    def stop(self, timeout=None):
+        drained = self.drain(timeout)
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify_all()
+        for thread in self.__threads:
+            thread.join()
+        with self.__db_lock:
+            # any messages claimed but not sent are queued again when the spool is next opened
+            self.__db.close()
+        return drained
+
+    def __claim(self):
+        """Marks up to batch_size due messages as 'sending' and returns them, or returns the time the next is due."""
+        now = time.time()
+        with self.__db_lock:
+            self.__db.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self.__db.execute(
+                    "SELECT id, sender, recipients, message, attempts FROM spool WHERE status = 'queued' AND "
+                    "next_attempt <= ? ORDER BY next_attempt, id LIMIT ?", (now, self.batch_size)).fetchall()
+                self.__db.executemany("UPDATE spool SET status = 'sending' WHERE id = ?", [(i[0],) for i in rows])
+                next_due = None
+                if not rows:
+                    next_due = self.__db.execute(
+                        "SELECT MIN(next_attempt) FROM spool WHERE status = 'queued'").fetchone()[0]
+                self.__db.execute('COMMIT')
+            except BaseException:
+                self.__db.execute('ROLLBACK')
+                raise
+        return rows, next_due
+
+    def __record(self, message_id, status, attempts, next_attempt=None, error=None):
+        with self.__db_lock:
+            self.__db.execute('UPDATE spool SET status = ?, attempts = ?, next_attempt = ?, error = ?, updated = ? '
+                              'WHERE id = ?', (status, attempts, next_attempt, error, time.time(), message_id))
+        with self.__condition:
+            self.__condition.notify_all()
+
+    def __work(self):
+        session = SMTPSession(self.mail)
+        try:
+            while self.__running:
+                # read before claiming, so a message put after an empty claim still wakes the wait below
+                with self.__condition:
+                    puts = self.__puts
+                rows, next_due = self.__claim()
+                if not rows:
+                    wait = self.idle_timeout if next_due is None else max(0, min(next_due - time.time(),
+                                                                                 self.idle_timeout))
+                    with self.__condition:
+                        woken = self.__condition.wait_for(lambda: self.__puts != puts or not self.__running, wait)
+                    if not woken and next_due is None:
+                        # idle, don't hold the connection open
+                        session.close()
+                    continue
+                for message_id, sender, recipients, message, attempts in rows:
+                    self.__deliver(session, message_id, sender, json.loads(recipients), message, attempts)
+        finally:
+            session.close()
+
+    def __deliver(self, session, message_id, sender, recipients, message, attempts):
+        attempts += 1
+        try:
+            refused = session.send_message(message, sender, recipients)
+        except Exception as e:
+            if _is_transient(e) and attempts <= self.retries:
+                delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+                self.__record(message_id, 'queued', attempts, time.time() + delay, repr(e))
+            else:
+                self.__record(message_id, 'failed', attempts, error=repr(e))
+        else:
+            # sent, though some recipients may have been refused
+            self.__record(message_id, 'sent', attempts, error=f'refused: {refused!r}' if refused else None)
@@ -2,14 +2,137 @@
 # -*- coding: utf-8 -*-
 
 
-"""fsconn module for file server connections."""
+"""fsconn module for file server connections.
+
+Parsed private keys are cached for the life of the process, keyed by the key file path, modification time and
+passphrase, so creating and connecting FSConnection objects only pays the key parsing (and passphrase KDF) cost once
+per key file.
+
+Functions:
+
+    load_private_key(keyfilepath, passphrase=None)
+
+    clear_key_cache()
+"""
 
 
 import paramiko
+import hashlib
+import hmac
 import os
+import threading
+
+
+# key classes tried, in order, when parsing a private key file
+KEY_CLASSES = (paramiko.RSAKey, paramiko.ECDSAKey, paramiko.Ed25519Key)
+
+# process-wide cache of parsed keys {(real path, mtime_ns, size, passphrase digest): key}
+_KEY_CACHE = {}
+_KEY_CACHE_LOCK = threading.Lock()
+# a lock per key file (real path) so parsing one key doesn't block loading the others
+_KEY_FILE_LOCKS = {}
+# the passphrase digests are keyed with a per-process secret so the cache doesn't hold plain hashes of them
+_PASSPHRASE_SECRET = os.urandom(32)
+
+
+def load_private_key(keyfilepath, passphrase=None):
+    """Parse and return a private key object (RSA, ECDSA or Ed25519), reusing a cached key if the file is unchanged.
+
+    :param keyfilepath: the path to the private key file.
+    :param passphrase: default None: the passphrase for an encrypted private key.
+    :return: returns a paramiko.PKey object.
+    """
+
+    stat = os.stat(keyfilepath)
+    path = os.path.realpath(keyfilepath)
+    cache_key = (path, stat.st_mtime_ns, stat.st_size, _passphrase_digest(passphrase))
+
+    with _KEY_CACHE_LOCK:
+        key = _KEY_CACHE.get(cache_key)
+        if key is not None:
+            return key
+        file_lock = _KEY_FILE_LOCKS.setdefault(path, threading.Lock())
+
+    with file_lock:
+        # another thread may have parsed the key while this one waited
+        with _KEY_CACHE_LOCK:
+            key = _KEY_CACHE.get(cache_key)
+        if key is not None:
+            return key
+
+        errors = []
+        for key_class in KEY_CLASSES:
+            try:
+                key = key_class.from_private_key_file(keyfilepath, password=passphrase)
+                break
+            except paramiko.PasswordRequiredException:
+                raise
+            except (paramiko.SSHException, ValueError) as e:
+                errors.append(f'{key_class.__name__}: {e}')
+        else:
+            raise paramiko.SSHException(f'Unable to parse private key file {keyfilepath}. ' + '; '.join(errors))
+
+        with _KEY_CACHE_LOCK:
+            # drop entries for older versions of the same file before caching the new key
+            for stale in [i for i in _KEY_CACHE if i[0] == path and i[1:3] != cache_key[1:3]]:
+                del _KEY_CACHE[stale]
+            _KEY_CACHE[cache_key] = key
+
+    return key
+
+
+def _passphrase_digest(passphrase):
+    """Return a digest identifying a passphrase in the key cache, or None for no passphrase."""
+
+    if passphrase is None:
+        return None
+    if isinstance(passphrase, str):
+        passphrase = passphrase.encode('utf-8')
+    return hmac.new(_PASSPHRASE_SECRET, passphrase, hashlib.sha256).digest()
+
+
+def clear_key_cache():
+    """Remove all parsed keys from the process-wide key cache."""
+    with _KEY_CACHE_LOCK:
+        _KEY_CACHE.clear()
+        _KEY_FILE_LOCKS.clear()
 
 
 class FSConnection:
+    """File server (SFTP) connection object.
+
+    Attributes
+    ----------
+        __keyfilepath:
+            the path to the SSH private key file (RSA, ECDSA or Ed25519)
+
+        __passphrase:
+            (Optional): the passphrase for an encrypted private key
+
+        __host:
+            the file server host name
+
+        __username:
+            the SSH username
+
+        port:
+            Default 22: the SSH port
+
+        use_agent:
+            Default False: whether to authenticate with keys from a running ssh-agent instead of a key file
+
+    Methods
+    -------
+        set_key():
+            loads the private key from the process-wide key cache, parsing the key file on first use
+
+        set_rsa_key():
+            alias of set_key() kept for backwards compatibility
+
+        get_sftp():
+            connects to the host and returns a paramiko SFTPClient
+    """
+
     def __init__(self, env='development'):
         if env == 'production':
             self.__keyfilepath = os.getenv('SSH_KEYPATH')
@@ -19,7 +142,9 @@ class FSConnection:
             self.__keyfilepath = os.getenv('SSH_DEV_KEYPATH')
             self.__host = os.getenv('SSH_DEV_HOST')
             self.__username = os.getenv('SSH_DEV_USERNAME')
+        self.__passphrase = os.getenv('SSH_KEY_PASSPHRASE')
         self.__port = os.getenv('SSH_PORT', 22)
+        self.__use_agent = False
         self.__key = None
 
     @property
@@ -72,11 +197,33 @@ class FSConnection:
         else:
             raise TypeError('The "port" attribute must be an integer. Have you tried 22?')
 
-    def set_rsa_key(self):
+    @property
+    def passphrase(self):
+        return 'Protected data.'
+
+    @passphrase.setter
+    def passphrase(self, value):
+        if isinstance(value, str):
+            self.__passphrase = value
+        else:
+            raise TypeError('The "passphrase" attribute must be a string.')
+
+    @property
+    def use_agent(self):
+        return self.__use_agent
+
+    @use_agent.setter
+    def use_agent(self, value):
+        if isinstance(value, bool):
+            self.__use_agent = value
+        else:
+            raise TypeError('The "use_agent" attribute must be boolean.')
+
+    def set_key(self):
         if self.__keyfilepath:
             if os.path.exists(self.__keyfilepath):
                 if os.path.isfile(self.__keyfilepath):
-                    self.__key = paramiko.RSAKey.from_private_key_file(self.__keyfilepath)
+                    self.__key = load_private_key(self.__keyfilepath, passphrase=self.__passphrase)
                 else:
                     raise FileNotFoundError(f'File {self.__keyfilepath} not found at specified path.')
             else:
@@ -84,18 +231,28 @@ class FSConnection:
         else:
             raise AttributeError('Please set the "keyfilepath" attribute with the path to the SSH private key.')
 
+    def set_rsa_key(self):
+        self.set_key()
+
     def get_sftp(self):
-        if self.__key:
-            if isinstance(self.__key, paramiko.rsakey.RSAKey):
-                ssh_client = paramiko.SSHClient()
-                ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh_client.connect(hostname=self.__host, username=self.__username, pkey=self.__key)
-                ftp_client = ssh_client.open_sftp()
+        ssh_client = paramiko.SSHClient()
+        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+
+        if self.__use_agent:
+            # let paramiko offer the keys held by the running ssh-agent
+            ssh_client.connect(hostname=self.__host, port=int(self.__port), username=self.__username,
+                               allow_agent=True, look_for_keys=False)
+        elif self.__key:
+            if isinstance(self.__key, paramiko.PKey):
+                ssh_client.connect(hostname=self.__host, port=int(self.__port), username=self.__username,
+                                   pkey=self.__key, allow_agent=False, look_for_keys=False)
             else:
-                raise TypeError('The rsa key must be properly set to call .get_sftp(). Did you set the keyfilepath '
-                                'attribute and call .set_rsa_key()?')
+                raise TypeError('The private key must be properly set to call .get_sftp(). Did you set the '
+                                'keyfilepath attribute and call .set_key()?')
         else:
             raise AttributeError('Please set the "keyfilepath" attribute with the path to the SSH private key then '
-                                 'call the .set_rsa_key() method before calling .get_sftp().')
+                                 'call the .set_key() method (or set use_agent = True) before calling .get_sftp().')
+
+        ftp_client = ssh_client.open_sftp()
 
         return ftp_client